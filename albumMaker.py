@@ -5,25 +5,62 @@
 #
 
 import ConfigParser
+import collections
+import hashlib
 import os
+import itertools
 import logging
 import re
 import argparse
 import sys
-from iptcinfo import IPTCInfo
-from PIL import Image, ImageDraw,ImageFont,ImageOps
-from PIL.ExifTags import TAGS
+import threading
+import cPickle
+from lazyModule import LazyModule
 from natsort import *
+from jpegHeader import readHeader, decodeIptcText, JpegHeaderError
+from metadataCache import MetadataCache
+from derivedImageCache import CacheDirectory, DerivedImageCache
+from pageManifest import PageManifest
+from profiling import profiler
+from pageWriter import OutputOptions, PageWriter, saveImage
+from imagePrefetcher import ImagePrefetcher
+from imageMemory import imageMemory
+from pageCanvas import MappedCanvas, drawOnPage
+from planReport import writePlanReport
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        # Backport of os.scandir for Python 2
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 from colorLogging import ColorizingStreamHandler
 
+# Imported on first use, see lazyModule
+Image = LazyModule('PIL.Image')
+ImageDraw = LazyModule('PIL.ImageDraw')
+ImageFont = LazyModule('PIL.ImageFont')
+ExifTags = LazyModule('PIL.ExifTags')
+iptcinfo = LazyModule('iptcinfo')
+multiprocessing = LazyModule('multiprocessing')
+
 
 logger = logging.getLogger('albumMaker')
 
+# Persistent metadata cache, None when disabled
+metadataCache = None
+# Persistent cache of the resized photos, None when disabled
+derivedImageCache = None
+
 
-class Slot:
+class Slot(object):
     """
     Define a picture slot in a layout
     """
+    __slots__ = ('orientation', 'imagePosition', 'textPosition')
+
     def __init__(self, orientation, imagePosition, textPosition):
         self.orientation = orientation
         self.imagePosition = imagePosition
@@ -38,8 +75,20 @@ class Slot:
     def getTextPosition(self):
         return self.textPosition
 
+    def accepts(self, signature):
+        """
+        Return whether an image of the given signature (see ImageAndPath.getSignature) fits in the slot
+        """
+        if signature == 'text-full':
+            return self.orientation == 'h' and self.textPosition.align == 'text'
+        elif signature == 'text':
+            return self.orientation == 'h'
+        return self.orientation == signature
+
+
+class Size(object):
+    __slots__ = ('x', 'y', 'x2', 'y2', 'align')
 
-class Size:
     def __init__(self, string):
         self.x = 0
         self.y = 0
@@ -66,66 +115,299 @@ class Size:
         return self.x, self.y
 
 
-class ImageAndPath:
+class ImageAndPath(object):
     IMAGE = 0
     TEXT = 1
+    # Every value of getSignature
+    SIGNATURES = ('h', 'v', 'text', 'text-full')
+    # One per input file, without a __dict__ since archives can hold hundreds of thousands of them
+    __slots__ = ('path', 'name', 'type', 'caption', 'image', 'header', 'jpegHeader', 'text', 'textHeight',
+                 'decodeSize', 'detectedOrientation', 'rotated', 'resized', 'onRelease')
 
-    def __init__(self, path):
+    def __init__(self, path, caption=None):
         self.path = path
+        # Computed once, layout matching and rendering ask for them many times
+        self.name = os.path.basename(path)
+        self.type = ImageAndPath.getTypeOfPath(path)
+        # Caption read ahead of rendering, see loadMetadata
+        self.caption = caption
         self.image = None
+        self.header = None
+        # JpegHeader read once for both probe and getCaption
+        self.jpegHeader = None
+        # Decoded content of a text file, read once
+        self.text = None
+        self.textHeight = None
+        self.decodeSize = None
         self.detectedOrientation = None
         self.rotated = False
+        # Image rotated and resized to the size of its slot, see getResizedImage
+        self.resized = None
+        # Called once the images are released, by the prefetcher accounting for them
+        self.onRelease = None
 
     def getPath(self):
         return self.path
 
     def getName(self):
-        return os.path.basename(self.path)
+        return self.name
 
     def getType(self):
-        if self.path.lower().endswith('.jpg'):
+        return self.type
+
+    @staticmethod
+    def getTypeOfPath(path):
+        extension = os.path.splitext(path)[1].lower()
+        if extension == '.jpg':
             return ImageAndPath.IMAGE
-        elif self.path.lower().endswith('.txt'):
+        elif extension == '.txt':
             return ImageAndPath.TEXT
 
     def getText(self):
-        text = ''
-        if self.getType() == ImageAndPath.TEXT:
-            f = open(self.path, 'r')
-            for line in f:
-                text += line.decode('utf-8')
-            f.close()
-        return text
+        if self.text is None:
+            text = ''
+            if self.getType() == ImageAndPath.TEXT:
+                f = open(self.path, 'r')
+                try:
+                    text = f.read().decode('utf-8')
+                finally:
+                    f.close()
+            self.text = text
+        return self.text
 
     def getImage(self):
-        if self.image is None:
+        # Kept in a local variable: self.image may be evicted by another thread at any time
+        currentImage = self.image
+        if currentImage is None:
             if self.getType() == ImageAndPath.IMAGE:
-                self.image = Image.open(self.path)
+                with profiler.phase('decode'):
+                    currentImage = Image.open(self.path)
+                    if self.decodeSize is not None and pageProperties.draftDecoding:
+                        # Let the JPEG decoder downscale by 1/2, 1/4 or 1/8 while still covering the decode size
+                        currentImage.draft(currentImage.mode, self.decodeSize)
+                        logger.debug('Decoding %s at %ix%i' % (self.path, currentImage.size[0], currentImage.size[1]))
+                    currentImage.load()
+                profiler.count('imagesDecoded')
             elif self.getType() == ImageAndPath.TEXT:
-                self.image = DrawUtils.getTextImage(
+                currentImage = DrawUtils.getTextImage(
                     self.getText(), pageProperties.finalImageFont,
                     int(pageProperties.finalImageFontSize * 1.3),
                     (pageProperties.imageResolutionLong,
                         pageProperties.imageResolutionLong * 2))
                 self.rotated = True
-        return self.image
+            self.image = currentImage
+            imageMemory.update(self)
+        else:
+            profiler.count('decodeCacheHits')
+            imageMemory.touch(self)
+        return currentImage
+
+    def evict(self):
+        """
+        Drop the decoded images to free memory, they are decoded again by the next getImage
+        """
+        self.image = None
+        self.resized = None
+        # The image will be decoded as stored in its file
+        self.rotated = False
 
     def release(self):
         self.image = None
+        self.resized = None
+        imageMemory.update(self)
+        if self.onRelease is not None:
+            onRelease = self.onRelease
+            self.onRelease = None
+            onRelease()
+
+    def getResizedImage(self, size):
+        """
+        Return the image rotated according to its EXIF orientation and resized to size.
+        The decoded image is dropped once resized, only the resized one is kept until release.
+        """
+        resized = self.resized
+        if resized is None or resized.size != size:
+            key = None
+            if derivedImageCache is not None:
+                # Decoding at a reduced scale changes the result of the resize
+                key = DerivedImageCache.getKey(self.path, MetadataCache.getFingerprint(self.path),
+                                               self.probe()[2], size, ('ANTIALIAS', pageProperties.draftDecoding))
+                resized = derivedImageCache.get(key)
+            if resized is None or resized.size != size:
+                self.setDecodeSize(size)
+                currentImage = self.rotateAccordingToExif()
+                with profiler.phase('resize'):
+                    resized = currentImage.resize(size, Image.ANTIALIAS)
+                if key is not None:
+                    derivedImageCache.put(key, resized)
+            self.resized = resized
+            self.image = None
+            self.rotated = False
+            imageMemory.update(self)
+        else:
+            imageMemory.touch(self)
+        return resized
+
+    def getMemorySize(self):
+        """
+        Return the number of bytes held by the decoded images
+        """
+        size = 0
+        for currentImage in (self.image, self.resized):
+            if currentImage is not None:
+                size += currentImage.size[0] * currentImage.size[1] * len(currentImage.getbands())
+        return size
+
+    def setDecodeSize(self, size):
+        """
+        Set the size the image will be resized to once rotated, so that it is not decoded at a higher resolution
+        than needed. Must be called before the image is loaded.
+        """
+        if self.getRotatedSize() != self.probe()[0:2]:
+            size = (size[1], size[0])
+        self.decodeSize = size
+
+    def getRotatedSize(self):
+        """
+        Return the size of the image once rotated according to its EXIF orientation, without decoding it
+        """
+        if self.getType() == ImageAndPath.TEXT:
+            return self.getImage().size
+        # Also right once rotated, whatever the resolution the image was decoded at
+        (width, height, orientation, detectedOrientation) = self.probe()
+        if orientation == 6 or orientation == 4 or orientation == 8:
+            return height, width
+        return width, height
+
+    def probe(self):
+        """
+        Read the dimensions and EXIF orientation of the image from its headers only, without decoding it.
+        The result is kept for the lifetime of the object.
+        :return: (width, height, exif orientation, detected orientation)
+        :rtype: tuple
+        """
+        if self.header is None:
+            if metadataCache is None:
+                (width, height, orientation) = self.readHeader()
+            else:
+                (width, height, orientation) = metadataCache.get(self.path, 'header', self.readHeader)
+            self.header = (width, height, orientation,
+                           ImageAndPath.getOrientationFromHeader(width, height, orientation))
+            logger.debug('Detected orientation %s for %s' % (self.header[3], self.getPath()))
+        return self.header
+
+    def readJpegHeader(self):
+        if self.jpegHeader is None:
+            self.jpegHeader = readHeader(self.path)
+        return self.jpegHeader
+
+    def readHeader(self):
+        try:
+            header = self.readJpegHeader()
+            return header.width, header.height, header.orientation
+        except (IOError, JpegHeaderError) as e:
+            logger.warning('Unable to read headers of %s (%s), opening the image' % (self.path, e))
+            currentImage = Image.open(self.path)
+            return currentImage.size[0], currentImage.size[1], ImageAndPath.getExifOrientationOfImage(currentImage)
+
+    def getTextHeight(self):
+        """
+        Return the height of the text once drawn by getImage, without drawing it
+        """
+        if self.textHeight is None:
+            # The font is only loaded, and PIL imported, on a cache miss
+            measure = lambda: DrawUtils.layoutText(self.getText(), (pageProperties.imageResolutionLong, 0),
+                                                   DrawUtils.getMeasureDraw(),
+                                                   DrawUtils.getFont(pageProperties.finalImageFont,
+                                                                     int(pageProperties.finalImageFontSize * 1.3))
+                                                   ).getHeight()
+            if metadataCache is None:
+                self.textHeight = measure()
+            else:
+                # The height depends on the font and the width too
+                self.textHeight = metadataCache.get(self.path, 'textHeight-%s-%i-%i' % (
+                    pageProperties.finalImageFont, pageProperties.finalImageFontSize,
+                    pageProperties.imageResolutionLong), measure)
+        return self.textHeight
+
+    def isFullPageText(self):
+        """
+        Return whether the text is too high to fit in a photo slot and needs a full page text slot
+        """
+        return self.getTextHeight() > pageProperties.imageResolutionShort
+
+    def readCaption(self):
+        try:
+            caption = self.readJpegHeader().caption
+            if caption is None:
+                return ''
+            return caption
+        except (IOError, JpegHeaderError):
+            pass
+        try:
+            info = iptcinfo.IPTCInfo(self.path)
+            # exiv2 -M"set Iptc.Application2.Caption La dream team!" 0-\ Le\ trajet\ et\ le\ chalet\ \ Pourchery\ \(2\).JPG
+            return Layout.getDecodedTitle(info.data['caption/abstract'])
+        except Exception as e:
+            logger.debug('No caption read from %s (%s)' % (self.path, e))
+            return ''
+
+    def getCaption(self):
+        if self.getType() != ImageAndPath.IMAGE:
+            return ''
+        if self.caption is None:
+            with profiler.phase('caption'):
+                if metadataCache is None:
+                    self.caption = self.readCaption()
+                else:
+                    # Not 'caption' nor 'headerCaption': captions cached before XMP descriptions were read, or read
+                    # from other XMP properties than dc:description, are ignored
+                    self.caption = metadataCache.get(self.path, 'xmpCaption', self.readCaption)
+        return self.caption
+
+    @staticmethod
+    def getExifOrientationOfImage(image):
+        info = image._getexif()
+        if info != None:
+            for tag, value in info.items():
+                decoded = ExifTags.TAGS.get(tag, tag)
+                if decoded == 'Orientation':
+                    return value
+
+    @staticmethod
+    def getOrientationFromHeader(width, height, orientation):
+        detectedOrientation = 'h'
+        if orientation <= 1:
+            # Use simple ratio
+            ratio = 1. * width / height
+            logger.debug('Detected ratio %f' % ratio)
+            if ratio > 1:
+                detectedOrientation = 'h'
+            elif ratio < 1:
+                detectedOrientation = 'v'
+        else:
+            # Use Exif orientation
+            logger.debug('Detected exif orientation %i' % orientation)
+            if orientation == 6 or orientation == 4 or orientation == 8:
+                detectedOrientation = 'v'
+            else:
+                logger.warning('Not supported EXIF orientation : %i' % orientation)
+                detectedOrientation = 'h'
+        return detectedOrientation
 
     def getExifOrientation(self):
         if self.rotated or self.getType() == ImageAndPath.TEXT:
             return 0
         else:
-            info = self.getImage()._getexif()
-            if info != None:
-                for tag, value in info.items():
-                    decoded = TAGS.get(tag, tag)
-                    if decoded == 'Orientation':
-                        return value
+            return self.probe()[2]
 
     def rotateAccordingToExif(self):
+        """
+        :return: the image rotated according to its EXIF orientation
+        :rtype: Image.Image
+        """
         orientation = self.getExifOrientation()
+        currentImage = self.getImage()
         if orientation > 1:
             if orientation == 6:
                 degree = Image.ROTATE_270
@@ -134,39 +416,44 @@ class ImageAndPath:
             else:
                 logger.error('EXIF orientation %i not supported yet' % orientation)
                 degree = 0
-            self.image = self.getImage().transpose(degree)
+            with profiler.phase('rotate'):
+                currentImage = currentImage.transpose(degree)
+            self.image = currentImage
+            imageMemory.update(self)
             logger.info('Image rotated of %i degrees' % degree)
         self.rotated = True
+        return currentImage
+
+    def getSignature(self):
+        """
+        Return what layout matching needs to know about the image: 'h' or 'v' for photos,
+        'text' for texts fitting in a photo slot and 'text-full' for texts needing a full page text slot
+        """
+        if self.getType() == ImageAndPath.TEXT:
+            if self.isFullPageText():
+                return 'text-full'
+            return 'text'
+        return self.getDetectedOrientation()
 
     def getDetectedOrientation(self):
         if self.getType() == ImageAndPath.TEXT:
             self.detectedOrientation = 'h'
         if self.detectedOrientation is None:
+            self.detectedOrientation = self.probe()[3]
+        return self.detectedOrientation
 
-            orientation = self.getExifOrientation()
-            currentImage = self.getImage()
-            self.detectedOrientation = 'h'
-
-            if orientation <= 1:
-                # Use simple ratio
-                ratio = 1.*currentImage.size[0] / currentImage.size[1]
-                logger.debug('Detected ratio %f' % ratio)
-                if ratio > 1:
-                    self.detectedOrientation = 'h'
-                elif ratio < 1:
-                    self.detectedOrientation = 'v'
-            else:
-                # Use Exif orientation
-                logger.debug('Detected exif orientation %i' % orientation)
-                if orientation == 6 or orientation == 4 or orientation == 8:
-                    self.detectedOrientation = 'v'
-                else:
-                    logger.warning('Not supported EXIF orientation : %i' % orientation)
-                    self.detectedOrientation = 'h'
-
-            logger.debug('Detected orientation %s for %s' % (self.detectedOrientation, self.getPath()))
 
-        return self.detectedOrientation
+def estimateDecodedPixels(imageAndPath, size, pageProperties):
+    """
+    Estimate the pixels decoded to resize a photo to size, from its headers only
+    """
+    (width, height) = imageAndPath.getRotatedSize()
+    # Scale the JPEG decoder downscales by, see ImageAndPath.setDecodeSize
+    scale = 1
+    while (pageProperties.draftDecoding and scale < 8 and
+           width / (scale * 2) >= size[0] and height / (scale * 2) >= size[1]):
+        scale *= 2
+    return width * height / (scale * scale)
 
 
 class Layout:
@@ -178,35 +465,94 @@ class Layout:
         self.name = name
         self.pageProperties = pageProperties
         self.slots = []
+        # Cost of a page using this layout, pages are planned to minimize the total cost
+        self.cost = 1.
         logger.info('Layout %s added' % name)
 
     def addSlot(self, orientation, imagePosition, textPosition):
         self.slots.append(Slot(orientation, imagePosition, textPosition))
         logger.info(' Slot with %s orientation added' % orientation)
 
-    def isCompatible(self, images):
-        if len(images) != len(self.slots):
-            return False
-        i = 0
-        for slot in self.slots:
-            currentImageAndPath = images[i]
-            i += 1
-            if currentImageAndPath.getType() == ImageAndPath.TEXT:
-                # FIXME use image height of generated text image instead of fixed number of letters
-                if len(currentImageAndPath.getText()) > 700:
-                    if slot.getTextPosition().align != 'text':
-                        return False
-                    else:
-                        logger.info('Full page text is detected')
-                else:
-                    logger.info('Image text is detected')
-            currentImage = currentImageAndPath.getImage()
-            detectedOrientation = currentImageAndPath.getDetectedOrientation()
+    def getAcceptedSignatures(self):
+        """
+        Return every tuple of image signatures accepted by the layout
+        """
+        return itertools.product(*[[signature for signature in ImageAndPath.SIGNATURES if slot.accepts(signature)]
+                                   for slot in self.slots])
 
-            if detectedOrientation != slot.getOrientation():
-                return False
+    def getSlotSize(self, slot):
+        """
+        :return: the size of the slot, None if its orientation is not supported
+        """
+        if slot.getOrientation() == 'h':
+            return self.pageProperties.imageResolutionLong, self.pageProperties.imageResolutionShort
+        elif slot.getOrientation() == 'v':
+            return self.pageProperties.imageResolutionShort, self.pageProperties.imageResolutionLong
+        return None
 
-        return True
+    def getOverhead(self, slot, imageAndPath):
+        """
+        Return how much smaller than its slot a photo is once resized to keep its ratio, negative for panoramas
+        overflowing it
+        """
+        (sizex, sizey) = self.getSlotSize(slot)
+        (curx, cury) = imageAndPath.getRotatedSize()
+        overheadx = 0
+        overheady = 0
+        if sizex * cury != sizey * curx:
+            # Not original ratio
+            if slot.getOrientation() == 'h':
+                if curx / cury > 2:
+                    logger.info("Panoramique image detected")
+                    overheadx = - int(sizex * 0.2)
+                    overheady = int(sizey - (sizex * 1.2 * cury / curx))
+                else:
+                    overheadx = sizex - (sizey * curx / cury)
+            else:
+                overheady = sizey - (sizex * cury / curx)
+        return overheadx, overheady
+
+    def prepareImage(self, slot, imageAndPath):
+        """
+        Decode, rotate and resize the image of a slot, as pasted by render
+        :rtype: Image.Image
+        """
+        if imageAndPath.getType() == ImageAndPath.TEXT:
+            return imageAndPath.rotateAccordingToExif()
+        (sizex, sizey) = self.getSlotSize(slot)
+        (overheadx, overheady) = self.getOverhead(slot, imageAndPath)
+        logger.debug('Resize image to %ix%i' % (sizex - overheadx, sizey - overheady))
+        return imageAndPath.getResizedImage((sizex - overheadx, sizey - overheady))
+
+    def estimateRenderCost(self, images):
+        """
+        Estimate the pixels decoded and resized to render a page with the images, from their headers only
+        :return: (decoded megapixels, resized megapixels)
+        :rtype: (float, float)
+        """
+        decoded = 0
+        resized = 0
+        for (slot, imageAndPath) in zip(self.slots, images):
+            if imageAndPath.getType() == ImageAndPath.TEXT:
+                # Drawn at the width of a photo slot, see ImageAndPath.getImage
+                resized += self.pageProperties.imageResolutionLong * imageAndPath.getTextHeight()
+                continue
+            if self.getSlotSize(slot) is None:
+                continue
+            (sizex, sizey) = self.getSlotSize(slot)
+            (overheadx, overheady) = self.getOverhead(slot, imageAndPath)
+            size = (sizex - overheadx, sizey - overheady)
+            decoded += estimateDecodedPixels(imageAndPath, size, self.pageProperties)
+            resized += size[0] * size[1]
+        return decoded / 1000000., resized / 1000000.
+
+    def prepare(self, images):
+        """
+        Prepare the images of every slot ahead of render, see ImagePrefetcher
+        """
+        for (slot, imageAndPath) in zip(self.slots, images):
+            if self.getSlotSize(slot) is not None:
+                self.prepareImage(slot, imageAndPath)
 
     def render(self, imageSrc, images):
         """
@@ -222,63 +568,32 @@ class Layout:
         for slot in self.slots:
             currentImageAndPath = images[i]
             i += 1
-            currentImageAndPath.rotateAccordingToExif()
-            currentImage = currentImageAndPath.getImage()
-
-            if slot.getOrientation() == 'h':
-                sizex = self.pageProperties.imageResolutionLong
-                sizey = self.pageProperties.imageResolutionShort
-            elif slot.getOrientation() == 'v':
-                sizex = self.pageProperties.imageResolutionShort
-                sizey = self.pageProperties.imageResolutionLong
-            else:
+            if self.getSlotSize(slot) is None:
                 logger.warning('Not supported orientation: ' + slot.getOrientation())
                 continue
+            (sizex, sizey) = self.getSlotSize(slot)
 
             if currentImageAndPath.getDetectedOrientation() != slot.getOrientation():
                 logger.error('Not the same orientation between detected and slot !!!')
 
             # Compute ratio deltas
-            curx = currentImage.size[0]
-            cury = currentImage.size[1]
-            overheadx = 0
-            overheady = 0
             deltax = 0
             deltay = 0
-
             if currentImageAndPath.getType() != ImageAndPath.TEXT:
-                if sizex * cury != sizey * curx:
-                    # Not original ratio
-                    if slot.getOrientation() == 'h':
-                        if curx / cury > 2:
-                            logger.info("Panoramique image detected")
-                            overheadx = - int(sizex * 0.2)
-                            overheady = int(sizey - (sizex * 1.2 * cury / curx))
-                        else:
-                            overheadx = sizex - (sizey * curx / cury) 
-                    else:
-                        overheady = sizey - (sizex * cury / curx)
+                (overheadx, overheady) = self.getOverhead(slot, currentImageAndPath)
                 deltax = overheadx / 2
                 deltay = overheady / 2
                 logger.debug('delta to apply %ix%i' % (deltax, deltay))
-
-                # Resize image
-                logger.debug('Resize image to %ix%i' % (sizex - overheadx, sizey - overheady))
-                currentImage = currentImage.resize((sizex - overheadx, sizey - overheady), Image.ANTIALIAS)
+            currentImage = self.prepareImage(slot, currentImageAndPath)
+            if currentImageAndPath.getType() == ImageAndPath.TEXT:
+                deltax = DrawUtils.getTextImageOffset(currentImage, self.pageProperties.imageResolutionLong)
 
             # Insert image 
-            imageSrc.paste(currentImage, (slot.getPosition().x + deltax, slot.getPosition().y + deltay))
-            title = ''
-            if currentImageAndPath.getType() == ImageAndPath.IMAGE:
-                try:
-                    info = IPTCInfo(currentImageAndPath.getPath())
-                    title = Layout.getDecodedTitle(info.data['caption/abstract'])
-                    # exiv2 -M"set Iptc.Application2.Caption La dream team!" 0-\ Le\ trajet\ et\ le\ chalet\ \ Pourchery\ \(2\).JPG
-                except:
-                    title = ''
+            with profiler.phase('paste'):
+                imageSrc.paste(currentImage, (slot.getPosition().x + deltax, slot.getPosition().y + deltay))
+            title = currentImageAndPath.getCaption()
     
-            d = ImageDraw.Draw(imageSrc)
-            font = ImageFont.truetype(self.pageProperties.finalImageFont, self.pageProperties.finalImageFontSize)
+            font = DrawUtils.getFont(self.pageProperties.finalImageFont, self.pageProperties.finalImageFontSize)
             logger.debug('Title = ' + title)
             automode = slot.getTextPosition().x == 0 and slot.getTextPosition().y == 0
             if automode:
@@ -304,8 +619,12 @@ class Layout:
                 maxsizey = 0
 
             if currentImageAndPath.getType() != ImageAndPath.TEXT:
-                DrawUtils.drawText(title, d, (positionx, positiony), (maxsizex, maxsizey), font, '#000000',
-                                   slot.getTextPosition().align)
+                align = slot.getTextPosition().align
+                bottom = positiony + DrawUtils.layoutText(title, (maxsizex, maxsizey), DrawUtils.getMeasureDraw(),
+                                                          font).getHeight() + DrawUtils.TEXT_IMAGE_MARGIN
+                drawOnPage(imageSrc, positiony, bottom,
+                           lambda draw, dy: DrawUtils.drawText(title, draw, (positionx, positiony + dy),
+                                                               (maxsizex, maxsizey), font, '#000000', align))
 
             logger.info("Image '%s' added" % currentImageAndPath.getName())
             Layout.allPicturesInserted += 1
@@ -313,79 +632,91 @@ class Layout:
 
     @staticmethod
     def getDecodedTitle(encodedTitle):
-        encodings = ['utf_8', 'iso_8859_15', 'latin_1']
-        for enc in encodings:
-            try:
-                title = encodedTitle.decode(enc)
-                if title is None:
-                    title = ''
-                return title
-            except Exception as e:
-                logging.error(e)
-                if enc == encodings[-1]:
-                    logger.error("Unable to decode comment")
-                    return ''
-
-    @staticmethod
-    def getCompatibleLayoutForOneImageNumber(layouts, images):
-        for l in layouts:
-            if l.isCompatible(images):
-                return l
-        return None
+        if encodedTitle is None:
+            return ''
+        return decodeIptcText(encodedTitle, False)
 
-    @staticmethod
-    def getCompatibleLayout(layouts, images):
-        imageNumber = min(3, len(images))
-        while imageNumber > 0:
-            compatibleLayout = Layout.getCompatibleLayoutForOneImageNumber(layouts, images[0:imageNumber])
-            if compatibleLayout != None:
-                return (imageNumber, compatibleLayout)
-            else:
-                imageNumber -= 1
 
-        logger.error('No layout compatible found')
-        return 0, None
+class LayoutIndex(list):
+    """
+    The layouts of the configuration, in configuration order, indexed by the signatures of the images they accept
+    (see ImageAndPath.getSignature), so that finding the layouts compatible with some images is a dict lookup
+    """
+    def __init__(self, layouts):
+        list.__init__(self, layouts)
+        # signatures -> compatible layouts, cheapest first then in configuration order
+        self.index = {}
+        for layout in sorted(layouts, key=lambda l: l.cost):
+            for signatures in layout.getAcceptedSignatures():
+                self.index.setdefault(signatures, []).append(layout)
+        self.byName = dict((layout.name, layout) for layout in layouts)
+        self.maxImageNumber = max([len(layout.slots) for layout in layouts] + [0])
+        logger.info('%i layouts indexed under %i signatures' % (len(layouts), len(self.index)))
+
+    def getLayout(self, name):
+        return self.byName[name]
+
+    def getCompatibleLayouts(self, signatures):
+        """
+        :type signatures: tuple
+        :rtype: list[Layout]
+        """
+        return self.index.get(signatures, [])
 
 
 def drawBookmark(image, chapterNumber, chapterName, pageProperties):
     positionx = pageProperties.finalImageResolution.x - pageProperties.bookmarksize.x
     positiony = int(100 + chapterNumber * pageProperties.bookmarksize.y * 1.2)
-    color = '#' + pageProperties.indexColors[chapterNumber % len(pageProperties.indexColors)]
+    color = pageProperties.indexColorsRGB[chapterNumber % len(pageProperties.indexColorsRGB)]
 
-    draw = ImageDraw.Draw(image)
-    draw.rectangle([(positionx, positiony), (positionx + pageProperties.bookmarksize.x,
-    positiony + pageProperties.bookmarksize.y)], fill=color)
+    # Pasted rather than drawn, so that it also works on a MappedCanvas. The box includes the bottom right corner,
+    # as ImageDraw.rectangle does
+    image.paste(color, (positionx, positiony, positionx + pageProperties.bookmarksize.x + 1,
+    positiony + pageProperties.bookmarksize.y + 1))
     if chapterName != '':
         logger.info("Printing chapter '%s' title" % chapterName)
-        font = ImageFont.truetype(pageProperties.bookmarkFont, pageProperties.bookmarkFontSize)
-        size = draw.textsize(chapterName, font)
+        font = DrawUtils.getFont(pageProperties.bookmarkFont, pageProperties.bookmarkFontSize)
+        size = DrawUtils.getTextSize(chapterName, DrawUtils.getMeasureDraw(), font)
         mask = Image.new('L', size)
         drawImg = ImageDraw.Draw(mask)
         drawImg.text((0,0), chapterName, 255, font)
         m2 = mask.rotate(90)
         textposx = positionx + pageProperties.bookmarksize.x / 2 - size[1] / 2
-        image.paste(ImageOps.colorize(m2, (0, 0, 0), (0, 0, 0)), (textposx, 400),  m2)
+        image.paste((0, 0, 0), (textposx, 400),  m2)
+
+
+def getIndexThumbnail(images):
+    """
+    Return the first photo of a chapter, used as its thumbnail in the index
+    """
+    for imageAndPath in images:
+        if imageAndPath.getType() == ImageAndPath.IMAGE:
+            return imageAndPath
+    return images[-1]
 
 
 def renderIndex(image, chapterList, chapters, pageProperties):
     deltax = 200
     for chapterNumber in chapters:
         chapterName = chapterList[chapterNumber]
-        font = ImageFont.truetype(pageProperties.bookmarkFont, pageProperties.bookmarkFontSize)
+        font = DrawUtils.getFont(pageProperties.bookmarkFont, pageProperties.bookmarkFontSize)
         draw = ImageDraw.Draw(image)
 
-        currentIndex = 0
-        thumbnailImageAndPath = chapters[chapterNumber][currentIndex]
-        while thumbnailImageAndPath.getType() != ImageAndPath.IMAGE and len(chapters[chapterNumber]) > currentIndex:
-            thumbnailImageAndPath = chapters[chapterNumber][currentIndex]
-            currentIndex += 1
-        thumbnailImageAndPath.rotateAccordingToExif()
-        thumbnailImage = thumbnailImageAndPath.getImage().copy()
+        thumbnailImageAndPath = getIndexThumbnail(chapters[chapterNumber])
         ratio = 3. / 2
         sizex = 240
-        sizey_keep = sizex * thumbnailImage.size[1] / thumbnailImage.size[0]
+        (thumbnailx, thumbnaily) = getIndexThumbnailSize(thumbnailImageAndPath, pageProperties)
+        sizey_keep = sizex * thumbnaily / thumbnailx
         sizey = sizex / ratio
-        thumbnailImage = thumbnailImage.resize((sizex, sizey_keep), Image.ANTIALIAS)
+        if thumbnailImageAndPath.getType() == ImageAndPath.IMAGE:
+            thumbnailImage = thumbnailImageAndPath.getResizedImage((sizex, sizey_keep))
+        else:
+            thumbnailImage = DrawUtils.getTextCanvas(thumbnailImageAndPath.rotateAccordingToExif(),
+                                                     (thumbnailx, thumbnaily))
+            with profiler.phase('resize'):
+                thumbnailImage = thumbnailImage.resize((sizex, sizey_keep), Image.ANTIALIAS)
+        # Only the thumbnail is needed from now on
+        thumbnailImageAndPath.release()
         if sizey_keep > sizey:
             thumbnailImage = thumbnailImage.crop((0, int((sizey_keep - sizey) / 2), sizex,
             int((sizey_keep - sizey) / 2 + sizey)))
@@ -405,19 +736,97 @@ def renderIndex(image, chapterList, chapters, pageProperties):
         logger.info("Chapter '%s' added to index" % chapterName)
 
 
+def getIndexThumbnailSize(thumbnailImageAndPath, pageProperties):
+    """
+    :return: the size of the index thumbnail before it is resized, the whole canvas a text is drawn on for texts
+    :rtype: (int, int)
+    """
+    if thumbnailImageAndPath.getType() == ImageAndPath.TEXT:
+        return pageProperties.imageResolutionLong, pageProperties.imageResolutionLong * 2
+    return thumbnailImageAndPath.getRotatedSize()
+
+
+def estimateIndexRenderCost(chapters, pageProperties):
+    """
+    Estimate the pixels decoded and resized to render the index, as Layout.estimateRenderCost does for pages
+    :return: (decoded megapixels, resized megapixels)
+    :rtype: (float, float)
+    """
+    decoded = 0
+    resized = 0
+    for chapterNumber in chapters:
+        thumbnailImageAndPath = getIndexThumbnail(chapters[chapterNumber])
+        (thumbnailx, thumbnaily) = getIndexThumbnailSize(thumbnailImageAndPath, pageProperties)
+        if thumbnailImageAndPath.getType() == ImageAndPath.TEXT:
+            # Pasted on its canvas then resized, see renderIndex
+            resized += thumbnailx * thumbnaily
+        size = (240, 240 * thumbnaily / thumbnailx)
+        if thumbnailImageAndPath.getType() == ImageAndPath.IMAGE:
+            decoded += estimateDecodedPixels(thumbnailImageAndPath, size, pageProperties)
+        resized += size[0] * size[1]
+    return decoded / 1000000., resized / 1000000.
+
+
+class TextLayout:
+    """
+    A text broken in lines, as drawn by DrawUtils.drawText
+    """
+    def __init__(self, lines):
+        # (text, size, style) for every line
+        self.lines = lines
+
+    def getInterline(self):
+        interline = 0
+        for line in self.lines:
+            interline = max(line[1][1], interline)
+        return interline
+
+    def getHeight(self):
+        if len(self.lines) == 0:
+            return 0
+        return int(self.getInterline() * (1.5 * (len(self.lines) - 1) + 1))
+
+
 class DrawUtils:
+    # (font file, size) -> font, so that every font is loaded once per process
+    fonts = {}
+    # (font, text) -> size of the text
+    textSizes = {}
+    TEXT_SIZES_LIMIT = 100000
+    measureDraw = None
+    # key of getTextImage -> image, least recently used first
+    textImages = collections.OrderedDict()
+    TEXT_IMAGES_LIMIT = 16
+    textImagesLock = threading.Lock()
+    # Where text images are kept between runs, None to keep them in memory only
+    textImageCache = None
+    # Margin below the last line, where the underline of a title is drawn
+    TEXT_IMAGE_MARGIN = 4
+
+    @staticmethod
+    def getFont(fontName, fontSize):
+        key = (fontName, fontSize)
+        font = DrawUtils.fonts.get(key)
+        if font is None:
+            logger.debug('Loading font %s of size %i' % key)
+            font = ImageFont.truetype(fontName, fontSize)
+            DrawUtils.fonts[key] = font
+            profiler.count('fontsLoaded')
+        else:
+            profiler.count('fontCacheHits')
+        return font
+
     @staticmethod
     def drawText(textToDraw, draw, position, boundingRect, font, color, align):
-        lines = DrawUtils.getLinesFromTitle(textToDraw, boundingRect, draw, font)
-        if boundingRect[1] == 0 and len(lines) > 1:
+        with profiler.phase('textLayout'):
+            textLayout = DrawUtils.layoutText(textToDraw, boundingRect, draw, font)
+        if boundingRect[1] == 0 and len(textLayout.lines) > 1:
             logger.error('Le texte est plus grand que la largeur de la photo !')
             # TODO bring support for multiline limit
         lineindex = 0
-        interline = 0
-        for line in lines:
-            interline = max(line[1][1], interline)
+        interline = textLayout.getInterline()
 
-        for line in lines:
+        for line in textLayout.lines:
             text = line[0]
             textsize = line[1]
             style = line[2]
@@ -441,68 +850,1068 @@ class DrawUtils:
             textsize[0], textsize[1], position[0] + deltatextx, 
             position[1] + lineindex * textsize[1] * 1.5, align))
             lineindex += 1
+        return textLayout
+
+    @staticmethod
+    def getTextSize(text, draw, font):
+        """
+        Measure a text once per font
+        """
+        key = (font, text)
+        size = DrawUtils.textSizes.get(key)
+        if size is None:
+            if len(DrawUtils.textSizes) >= DrawUtils.TEXT_SIZES_LIMIT:
+                DrawUtils.textSizes.clear()
+            size = draw.textsize(text, font)
+            DrawUtils.textSizes[key] = size
+        return size
 
     @staticmethod
-    def getLinesFromTitle(title, boundingbox, draw, font):
+    def getMeasureDraw():
+        """
+        Return a drawing context only used to measure texts
+        """
+        if DrawUtils.measureDraw is None:
+            DrawUtils.measureDraw = ImageDraw.Draw(Image.new('L', (1, 1)))
+        return DrawUtils.measureDraw
+
+    @staticmethod
+    def layoutText(title, boundingbox, draw, font):
+        """
+        Break a text in lines fitting the width of boundingbox.
+        Words are measured once, the width of a line is first estimated from the width of its words and spaces,
+        then checked by measuring the line around the estimated break.
+        :rtype: TextLayout
+        """
         title = title.replace('\r', '')
         titleRealLine = title.split('\n')
         lines = []
+        spaceWidth = DrawUtils.getTextSize(' ', draw, font)[0]
         for realLine in titleRealLine:
             titletab = realLine.split(' ')
-            line = ''
-            oldline = ''
-            oldtextsize = 0
             if titletab[0] == 'h1.':
                 style = 'H1'
                 titletab = titletab[1:]
             else:
                 style = 'N'
-            for word in titletab:
-                wordProcessed = False
-                while wordProcessed == False:
-                    line += word
-                    textsize = draw.textsize(line, font)
-                    line += ' '
-                    if textsize[0] > boundingbox[0]:
-                        lines.append((oldline[0:len(oldline)-1], oldtextsize, style))
-                        line = ''
-                    else:
-                        wordProcessed = True
-                    oldline = line
-                    oldtextsize = textsize
-
-            if oldtextsize == 0:
-                oldtextsize = textsize
-            lines.append((oldline[0:len(oldline)-1], oldtextsize, style))
-        return lines
+            if len(titletab) == 0:
+                if len(lines) > 0:
+                    lines.append(('', lines[-1][1], style))
+                else:
+                    lines.append(('', (0, 0), style))
+                continue
+
+            wordWidths = [DrawUtils.getTextSize(word, draw, font)[0] for word in titletab]
+            start = 0
+            while start < len(titletab):
+                # Estimated break: as many words as their summed widths allow, at least one
+                wordNumber = 1
+                width = wordWidths[start]
+                while start + wordNumber < len(titletab) and \
+                        width + spaceWidth + wordWidths[start + wordNumber] <= boundingbox[0]:
+                    width += spaceWidth + wordWidths[start + wordNumber]
+                    wordNumber += 1
+
+                # Exact break: the line fits and the line with one more word does not
+                line = ' '.join(titletab[start:start + wordNumber])
+                textsize = DrawUtils.getTextSize(line, draw, font)
+                if textsize[0] <= boundingbox[0]:
+                    while start + wordNumber < len(titletab):
+                        longerLine = line + ' ' + titletab[start + wordNumber]
+                        longerTextsize = DrawUtils.getTextSize(longerLine, draw, font)
+                        if longerTextsize[0] > boundingbox[0]:
+                            break
+                        (line, textsize) = (longerLine, longerTextsize)
+                        wordNumber += 1
+                else:
+                    # A word wider than the bounding box gets a line of its own
+                    while wordNumber > 1 and textsize[0] > boundingbox[0]:
+                        wordNumber -= 1
+                        line = ' '.join(titletab[start:start + wordNumber])
+                        textsize = DrawUtils.getTextSize(line, draw, font)
+
+                lines.append((line, textsize, style))
+                start += wordNumber
+        return TextLayout(lines)
 
     @staticmethod
     def getTextImage(text, fontName, fontSize, resolution):
-        image = Image.new('RGB', resolution, '#' + pageProperties.finalImageBackgroundColor)
+        """
+        Return the image of a text, drawn once per text and font settings. The image is shared, it must not be
+        modified.
+        """
+        key = hashlib.sha1(repr((text.encode('utf-8'), fontName, fontSize, resolution,
+                                 pageProperties.backgroundColorRGB))).hexdigest()
+        with DrawUtils.textImagesLock:
+            image = DrawUtils.textImages.pop(key, None)
+        if image is not None:
+            profiler.count('textImageCacheHits')
+        else:
+            image = DrawUtils.loadTextImage(key)
+            if image is None:
+                image = DrawUtils.drawTextImage(text, fontName, fontSize, resolution)
+                DrawUtils.saveTextImage(key, image)
+        with DrawUtils.textImagesLock:
+            DrawUtils.textImages[key] = image
+            if len(DrawUtils.textImages) > DrawUtils.TEXT_IMAGES_LIMIT:
+                DrawUtils.textImages.popitem(last=False)
+        return image
+
+    @staticmethod
+    def drawTextImage(text, fontName, fontSize, resolution):
+        """
+        Draw a text centered in the width of resolution, the image being cropped to the bounding box of its lines.
+        The image is pasted getTextImageOffset away from the left of the canvas it has been cropped from.
+        """
+        image = Image.new('RGB', resolution, pageProperties.backgroundColorRGB)
         d = ImageDraw.Draw(image)
 
-        font = ImageFont.truetype(fontName, fontSize)
-        DrawUtils.drawText(text, d, (0, 0), resolution , font, '#000000', 'center')
+        font = DrawUtils.getFont(fontName, fontSize)
+        with profiler.phase('textDrawing'):
+            textLayout = DrawUtils.drawText(text, d, (0, 0), resolution , font, '#000000', 'center')
+        width = 0
+        for line in textLayout.lines:
+            width = max(line[1][0], width)
+        if width == 0:
+            width = resolution[0]
+        # Lines are centered as in drawText, the widest one starts at the left of the box
+        left = resolution[0] / 2 - width / 2
+        height = min(resolution[1], textLayout.getHeight() + DrawUtils.TEXT_IMAGE_MARGIN)
+        profiler.count('textImagesDrawn')
+        return image.crop((left, 0, left + width, height))
+
+    @staticmethod
+    def getTextImageOffset(image, canvasWidth):
+        """
+        Return the distance between the left of the canvas a text image is drawn on and the image, see
+        drawTextImage
+        """
+        return canvasWidth / 2 - image.size[0] / 2
+
+    @staticmethod
+    def getTextCanvas(image, resolution):
+        """
+        Return the whole canvas of resolution a text image has been cropped from
+        """
+        canvas = Image.new('RGB', resolution, pageProperties.backgroundColorRGB)
+        canvas.paste(image, (DrawUtils.getTextImageOffset(image, resolution[0]), 0))
+        return canvas
+
+    @staticmethod
+    def loadTextImage(key):
+        if DrawUtils.textImageCache is None:
+            return None
+        path = DrawUtils.textImageCache.getPath(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            image = Image.open(path)
+            image.load()
+        except IOError as e:
+            logger.warning('Unable to read cached text image %s (%s)' % (path, e))
+            return None
+        DrawUtils.textImageCache.touch(path)
+        profiler.count('textImageDiskHits')
         return image
 
+    @staticmethod
+    def saveTextImage(key, image):
+        if DrawUtils.textImageCache is None:
+            return
+        path = DrawUtils.textImageCache.getPath(key)
+        try:
+            # Renamed once complete, so that another process never reads a partial image
+            temporaryPath = '%s.tmp-%i-%i' % (path, os.getpid(), threading.current_thread().ident)
+            image.save(temporaryPath, 'PNG')
+            os.rename(temporaryPath, path)
+            DrawUtils.textImageCache.added(path)
+        except (IOError, OSError) as e:
+            logger.warning('Unable to write cached text image %s (%s)' % (path, e))
+
 
 def getNewPageImage(pageProperties):
-    image = Image.new('RGB', pageProperties.finalImageResolution.getTuple(), '#' +
-    pageProperties.finalImageBackgroundColor)
+    image = Image.new('RGB', pageProperties.finalImageResolution.getTuple(), pageProperties.backgroundColorRGB)
 
     return image
 
 
+def getRGBColor(hexColor):
+    """
+    :param hexColor: color as in the configuration, 'rrggbb'
+    :rtype: tuple
+    """
+    return tuple(int(hexColor[i:i + 2], 16) for i in (0, 2, 4))
+
+
+class PageTemplates:
+    """
+    Empty pages with the bookmark of a chapter, drawn once and copied for every page of the chapter
+    """
+    # (chapter number, chapter name) -> template, the name being '' on the pages after the first one
+    templates = {}
+    TEMPLATES_LIMIT = 4
+
+    @staticmethod
+    def getPageImage(pageProperties, chapterNumber, chapterName, canvasPath):
+        """
+        :param canvasPath: file of the page canvas when pages are memory-mapped
+        :rtype: Image.Image or MappedCanvas
+        """
+        if pageProperties.mappedCanvas:
+            # Filling the file is as cheap as copying a template would be
+            canvas = MappedCanvas(canvasPath, pageProperties.finalImageResolution.getTuple(),
+                                  pageProperties.backgroundColorRGB, pageProperties.canvasStripHeight)
+            try:
+                drawBookmark(canvas, chapterNumber, chapterName, pageProperties)
+            except:
+                canvas.close()
+                raise
+            return canvas
+        key = (chapterNumber, chapterName)
+        template = PageTemplates.templates.get(key)
+        if template is None:
+            if len(PageTemplates.templates) >= PageTemplates.TEMPLATES_LIMIT:
+                # Chapters are rendered in order, the templates of the previous ones are not needed anymore
+                PageTemplates.templates.clear()
+            with profiler.phase('template'):
+                template = getNewPageImage(pageProperties)
+                drawBookmark(template, chapterNumber, chapterName, pageProperties)
+            PageTemplates.templates[key] = template
+            profiler.count('templatesDrawn')
+        return template.copy()
+
+
+CHAPTER_PATTERN = re.compile(r'.*/(?P<chapter>\d+) *- *(?P<chapterName>.*)\((?P<number>\d+)\).*')
+
+
+def listInputFiles(inputdir):
+    """
+    Return the names of the photos and texts of the input directory, in natural order
+    """
+    if scandir is not None:
+        filenames = [entry.name for entry in scandir(inputdir)]
+    else:
+        filenames = os.listdir(inputdir)
+    filenames = [filename for filename in filenames
+                 if filename.lower().endswith('.jpg') or filename.lower().endswith('.txt')]
+    filenames.sort(key=natsort_key)
+    return filenames
+
+
+def iterChapters(inputdir):
+    """
+    Yield (chapter number, chapter name, images) for every chapter of the input directory, as soon as all its files
+    have been listed. Files are named '<chapter> - <chapter name> (<number>).jpg|txt', so the natural order keeps
+    the files of a chapter together.
+    """
+    with profiler.phase('listing'):
+        filenames = listInputFiles(inputdir)
+    chapter = None
+    for filename in filenames:
+        path = inputdir + filename
+        with profiler.phase('chapterParsing'):
+            match = CHAPTER_PATTERN.match(path)
+        if match is None:
+            logger.warning("'%s' does not follow the '<chapter> - <chapter name> (<number>)' naming, ignored" %
+                           filename)
+            continue
+        logger.debug(path)
+        chapterNumber = int(match.group('chapter'))
+        if chapter is not None and chapter[0] != chapterNumber:
+            yield chapter
+            chapter = None
+        if chapter is None:
+            chapter = (chapterNumber, match.group('chapterName').strip().decode('utf-8'), [])
+        chapter[2].append(ImageAndPath(path))
+    if chapter is not None:
+        yield chapter
+
+
+def scanInputDirectory(inputdir):
+    """
+    List the photos and texts of the input directory, grouped by chapter
+    :return: chapter number -> images, chapter number -> chapter name
+    :rtype: (dict, dict)
+    """
+    chapterList = {}
+    chapters = {}
+    for (chapterNumber, chapterName, images) in iterChapters(inputdir):
+        if chapters.has_key(chapterNumber):
+            chapters[chapterNumber] += images
+        else:
+            chapters[chapterNumber] = images
+            chapterList[chapterNumber] = chapterName
+    return chapters, chapterList
+
+
+def loadMetadata(images):
+    """
+    Read the metadata of the input files of a chapter ahead of rendering, headers and captions in a single read
+    of each photo, through the metadata cache if any. The cache is saved so that rendering processes find
+    everything in it.
+    """
+    for imageAndPath in images:
+        if imageAndPath.getType() == ImageAndPath.IMAGE:
+            imageAndPath.probe()
+            imageAndPath.getCaption()
+        else:
+            imageAndPath.getTextHeight()
+    if metadataCache is not None:
+        logger.info('Metadata loaded (%i cache hits, %i misses)' % (metadataCache.hits, metadataCache.misses))
+        metadataCache.save()
+
+
+class PagePlan:
+    """
+    Everything needed to render one page, independently of the others
+    """
+    def __init__(self, page, chapterNumber, chapterName, layoutName, paths, outputdir, captions=None):
+        self.page = page
+        self.chapterNumber = chapterNumber
+        self.chapterName = chapterName
+        self.layoutName = layoutName
+        self.paths = paths
+        self.outputdir = outputdir
+        # Caption of every path, read while planning so that rendering does not read them again
+        if captions is None:
+            captions = [None] * len(paths)
+        self.captions = captions
+        # Index of the album of the page in batch mode, see Album
+        self.album = None
+
+    def getOutputPath(self):
+        return getPageOutputPath(self.outputdir, self.page)
+
+    def getImages(self):
+        """
+        :rtype: list[ImageAndPath]
+        """
+        return [ImageAndPath(path, caption) for (path, caption) in zip(self.paths, self.captions)]
+
+
+def getPageOutputPath(outputdir, page):
+    return '%s/page-%i.%s' % (outputdir, page, pageProperties.outputOptions.getExtension())
+
+
+def getRenderingProperties(pageProperties):
+    """
+    Return the page properties the rendered pages depend on, leaving out the tuning of the rendering pipeline
+    """
+    properties = dict(vars(pageProperties))
+    for name in ('outputEncoders', 'outputQueueSize', 'prefetchPages', 'prefetchMemoryMB', 'prefetchThreads',
+                 'memoryBudgetMB', 'derivedCacheMaxSizeMB', 'textCacheMaxSizeMB', 'mappedCanvas',
+                 'canvasStripHeight'):
+        del properties[name]
+    return properties
+
+
+def getPageSignatures(pagePlans, layouts, chapterList, chapters):
+    """
+    Compute the signature of the index and of every planned page, from everything their rendering depends on
+    :return: page number -> signature
+    :rtype: dict
+    """
+    signatures = {0: PageManifest.getSignature({
+        'properties': getRenderingProperties(pageProperties),
+        'chapters': [(chapterNumber, chapterList[chapterNumber],
+                      MetadataCache.getFingerprint(getIndexThumbnail(chapters[chapterNumber]).getPath()))
+                     for chapterNumber in chapters]})}
+    for pagePlan in pagePlans:
+        layout = layouts.getLayout(pagePlan.layoutName)
+        signatures[pagePlan.page] = PageManifest.getSignature({
+            'properties': getRenderingProperties(layout.pageProperties),
+            'layout': (layout.name, layout.slots),
+            'chapterNumber': pagePlan.chapterNumber,
+            'chapterName': pagePlan.chapterName,
+            'inputs': [(path, MetadataCache.getFingerprint(path)) for path in pagePlan.paths]})
+    return signatures
+
+
+def planPages(layouts, chapters, chapterList, outputdir):
+    """
+    Assign a layout to every page of every chapter without rendering anything
+    :return: the page plans and False if some images fit no layout and were left out
+    :rtype: (list[PagePlan], bool)
+    """
+    pagePlans = []
+    complete = True
+    for chapterNumber in chapters:
+        (chapterPlans, chapterComplete) = planChapter(layouts, chapterNumber, chapterList[chapterNumber],
+                                                      chapters[chapterNumber], len(pagePlans) + 1, outputdir)
+        pagePlans += chapterPlans
+        complete = complete and chapterComplete
+    return pagePlans, complete
+
+
+def planLayouts(layouts, signatures):
+    """
+    Split a sequence of images in pages of minimal total cost (the number of pages, unless layouts have
+    a cost), by dynamic programming over the position in the sequence.
+    Images are only left out when they fit no layout: the number of images left out is minimized first,
+    whatever the costs of the layouts.
+    On equal cost, pages with more images come first, then layouts in configuration order.
+    :param signatures: the signature of every image, see ImageAndPath.getSignature
+    :return: (first image, image number, layout) for every page, layout being None for images left out
+    :rtype: list[tuple]
+    :type layouts: LayoutIndex
+    """
+    imageCount = len(signatures)
+    # best[i] is the minimal (images left out, cost) of the images from i, reached by choice[i] = (image number,
+    # layout)
+    best = [(0, 0.)] * (imageCount + 1)
+    choice = [None] * (imageCount + 1)
+    for index in range(imageCount - 1, -1, -1):
+        best[index] = (best[index + 1][0] + 1, best[index + 1][1])
+        choice[index] = (1, None)
+        for imageNumber in range(min(layouts.maxImageNumber, imageCount - index), 0, -1):
+            compatibleLayouts = layouts.getCompatibleLayouts(tuple(signatures[index:index + imageNumber]))
+            if len(compatibleLayouts) > 0:
+                layout = compatibleLayouts[0]
+                (skipped, cost) = best[index + imageNumber]
+                if (skipped, layout.cost + cost) < best[index]:
+                    best[index] = (skipped, layout.cost + cost)
+                    choice[index] = (imageNumber, layout)
+
+    pages = []
+    index = 0
+    while index < imageCount:
+        (imageNumber, layout) = choice[index]
+        pages.append((index, imageNumber, layout))
+        index += imageNumber
+    return pages
+
+
+def planChapter(layouts, chapterNumber, chapterName, images, firstPage, outputdir):
+    """
+    Assign a layout to every page of a chapter
+    :param firstPage: number of the first page of the chapter
+    :return: the page plans and False if some images of the chapter fit no layout and were left out
+    :rtype: (list[PagePlan], bool)
+    """
+    pagePlans = []
+    page = firstPage
+    complete = True
+    logger.info(" ** Starting chapter '%s'" % chapterName)
+    with profiler.phase('layoutMatching'):
+        signatures = [imageAndPath.getSignature() for imageAndPath in images]
+        plannedPages = planLayouts(layouts, signatures)
+
+    for (index, imageNumber, compatibleLayout) in plannedPages:
+        if compatibleLayout is None:
+            logger.error("No layout compatible found for '%s', left out" % images[index].getName())
+            complete = False
+            continue
+
+        if len(pagePlans) == 0:
+            bookmarkName = chapterName
+        else:
+            bookmarkName = ''
+        pageImages = images[index:index + imageNumber]
+        pagePlans.append(PagePlan(page, chapterNumber, bookmarkName, compatibleLayout.name,
+                                  [i.getPath() for i in pageImages], outputdir, [i.getCaption() for i in pageImages]))
+
+        logger.info(' ==> Page %i will be rendered with image %i to %i with layout %s' %
+                    (page, index, index + imageNumber, compatibleLayout.name))
+
+        page += 1
+    return pagePlans, complete
+
+
+def renderPage(pagePlan, layouts, pageWriter=None, prefetcher=None):
+    """
+    Render and save one planned page
+    :param pageWriter: writer encoding the page in the background, the page is saved synchronously if None
+    :param prefetcher: prefetcher the page has been scheduled on, if any
+    :return: the number of pictures inserted in the page
+    :rtype: int
+    """
+    # Page numbers are not unique in batch mode
+    profiler.setPage(pagePlan.getOutputPath())
+    with profiler.phase('page'):
+        pageImage = composePage(pagePlan, layouts, prefetcher)
+        if pageWriter is None:
+            saveImage(pageImage, pagePlan.getOutputPath(), layouts[0].pageProperties.outputOptions)
+        else:
+            pageWriter.write(pageImage, pagePlan.getOutputPath())
+    profiler.setPage(None)
+    logger.info(' ==> Page %i has been rendered with layout %s' % (pagePlan.page, pagePlan.layoutName))
+    return len(pagePlan.paths)
+
+
+def composePage(pagePlan, layouts, prefetcher=None):
+    """
+    Build the image of one planned page, without saving it
+    :param prefetcher: prefetcher the page has been scheduled on, if any
+    :rtype: Image.Image
+    """
+    logger.info('   > Starting rendering page %i' % pagePlan.page)
+    layout = layouts.getLayout(pagePlan.layoutName)
+    pageImage = PageTemplates.getPageImage(layout.pageProperties, pagePlan.chapterNumber, pagePlan.chapterName,
+                                           pagePlan.getOutputPath() + '.canvas')
+    try:
+        images = None
+        if prefetcher is not None:
+            with profiler.phase('prefetchWait'):
+                images = prefetcher.take(pagePlan)
+        if images is None:
+            images = pagePlan.getImages()
+        layout.render(pageImage, images)
+    except:
+        # Otherwise the full size file of the canvas would be left in the output directory
+        if isinstance(pageImage, MappedCanvas):
+            pageImage.close()
+        raise
+    return pageImage
+
+
+class Album:
+    """
+    An input directory rendered to an output directory, with its own caches
+    """
+    def __init__(self, inputdir, outputdir):
+        self.inputdir = inputdir
+        self.outputdir = outputdir
+        self.name = os.path.basename(os.path.normpath(inputdir))
+        self.metadataCache = None
+        self.derivedImageCache = None
+        self.textImageCache = None
+        self.chapters = {}
+        self.chapterList = {}
+        self.pagePlans = []
+        # Planned pages not submitted to the renderer yet
+        self.plansToRender = []
+        self.mustRenderIndex = True
+        self.complete = True
+        self.manifest = None
+        self.signatures = None
+        self.toRender = None
+        # Error preventing the album from being planned, None if it has been planned
+        self.error = None
+        # (page, error) of the pages that could not be rendered
+        self.failures = []
+        self.pagesLeft = 0
+
+    def openCaches(self, cacheFile, noCache):
+        """
+        :param cacheFile: metadata cache file, <inputdir>/.albumMaker-cache.sqlite if None
+        """
+        if noCache:
+            return
+        if cacheFile is None:
+            cacheFile = self.inputdir + '.albumMaker-cache.sqlite'
+        self.metadataCache = MetadataCache(cacheFile)
+        if pageProperties.textCacheMaxSizeMB > 0:
+            self.textImageCache = CacheDirectory(os.path.splitext(cacheFile)[0] + '-text', '.png',
+                                                 pageProperties.textCacheMaxSizeMB, 'text image')
+        if pageProperties.derivedCacheMaxSizeMB > 0:
+            self.derivedImageCache = DerivedImageCache(os.path.splitext(cacheFile)[0] + '-resized',
+                                                       pageProperties.derivedCacheMaxSizeMB)
+
+    def activate(self):
+        """
+        Make the caches of the album the ones used by ImageAndPath and DrawUtils
+        """
+        global metadataCache, derivedImageCache
+        metadataCache = self.metadataCache
+        derivedImageCache = self.derivedImageCache
+        DrawUtils.textImageCache = self.textImageCache
+
+    def plan(self, layouts, chapterStream, incremental, renderer=None):
+        """
+        Plan every page of the album and select the ones to render
+        :param chapterStream: (chapter number, chapter name, images) of every chapter, see iterChapters
+        :param renderer: renderer the pages of a chapter are submitted to as soon as they are planned, unless
+        incremental, in which case pages can only be selected once every page is planned
+        """
+        self.activate()
+        for (chapterNumber, chapterName, images) in chapterStream:
+            if self.chapters.has_key(chapterNumber):
+                logger.error('Files of chapter %i are not listed together' % chapterNumber)
+            self.chapters[chapterNumber] = images
+            self.chapterList[chapterNumber] = chapterName
+            with profiler.phase('metadata'):
+                loadMetadata(images)
+            (chapterPlans, chapterComplete) = planChapter(layouts, chapterNumber, chapterName, images,
+                                                          len(self.pagePlans) + 1, self.outputdir)
+            self.pagePlans += chapterPlans
+            self.complete = self.complete and chapterComplete
+            if renderer is not None and not incremental:
+                renderer.submit(chapterPlans)
+
+        if incremental:
+            self.manifest = PageManifest(self.outputdir + '.albumMaker-manifest.json')
+            self.signatures = getPageSignatures(self.pagePlans, layouts, self.chapterList, self.chapters)
+            self.toRender = self.manifest.update(self.signatures,
+                                                 lambda page: getPageOutputPath(self.outputdir, page))
+            self.plansToRender = [pagePlan for pagePlan in self.pagePlans if pagePlan.page in self.toRender]
+            self.mustRenderIndex = 0 in self.toRender
+        elif renderer is None:
+            self.plansToRender = list(self.pagePlans)
+        self.pagesLeft = len(self.plansToRender)
+
+    def renderIndexPage(self):
+        logger.info('Starting index rendering')
+        profiler.setPage(getPageOutputPath(self.outputdir, 0))
+        with profiler.phase('index'):
+            pageImage = getNewPageImage(pageProperties)
+            renderIndex(pageImage, self.chapterList, self.chapters, pageProperties)
+            saveImage(pageImage, getPageOutputPath(self.outputdir, 0), pageProperties.outputOptions)
+        profiler.setPage(None)
+        logger.info('Index rendered')
+
+    def pageRendered(self, pagePlan):
+        self.pagesLeft -= 1
+        if self.pagesLeft == 0:
+            logger.info("Every page of album '%s' rendered" % self.name)
+
+    def finish(self):
+        """
+        Record the rendered pages in the manifest, the failed ones being rendered again by the next run
+        """
+        if self.manifest is not None:
+            failedPages = set(page for (page, error) in self.failures)
+            self.manifest.setRendered(dict((page, self.signatures[page]) for page in self.toRender
+                                           if page not in failedPages))
+
+    def getPlanRows(self, layouts):
+        """
+        Describe the index and every planned page with its estimated cost, see planReport
+        :rtype: list[dict]
+        """
+        imagesByPath = dict((imageAndPath.getPath(), imageAndPath)
+                            for images in self.chapters.values() for imageAndPath in images)
+        # Every pixel of a page is composed then encoded
+        pageMegapixels = (pageProperties.finalImageResolution.x * pageProperties.finalImageResolution.y / 1000000.)
+        (decoded, resized) = estimateIndexRenderCost(self.chapters, pageProperties)
+        rows = [{
+            'album': self.name.decode('utf-8', 'replace'),
+            'page': 0,
+            'chapter': None,
+            'chapterName': u'',
+            'layout': 'index',
+            'images': [getIndexThumbnail(self.chapters[chapterNumber]).getName().decode('utf-8', 'replace')
+                       for chapterNumber in self.chapters],
+            'decodedMegapixels': round(decoded, 3),
+            'resizedMegapixels': round(resized, 3),
+            'estimatedCost': round(decoded + resized + pageMegapixels, 3),
+        }]
+        for pagePlan in self.pagePlans:
+            images = [imagesByPath[path] for path in pagePlan.paths]
+            (decoded, resized) = layouts.getLayout(pagePlan.layoutName).estimateRenderCost(images)
+            rows.append({
+                'album': self.name.decode('utf-8', 'replace'),
+                'page': pagePlan.page,
+                'chapter': pagePlan.chapterNumber,
+                'chapterName': self.chapterList[pagePlan.chapterNumber],
+                'layout': pagePlan.layoutName,
+                'images': [imageAndPath.getName().decode('utf-8', 'replace') for imageAndPath in images],
+                'decodedMegapixels': round(decoded, 3),
+                'resizedMegapixels': round(resized, 3),
+                'estimatedCost': round(decoded + resized + pageMegapixels, 3),
+            })
+        return rows
+
+    def getSummary(self):
+        if self.error is not None:
+            return "Album '%s' could not be planned: %s" % (self.name, self.error)
+        summary = "Album '%s' rendered in %i pages" % (self.name, len(self.pagePlans) + 1)
+        if not self.complete:
+            summary += ', some images fit no layout and were left out'
+        if len(self.failures) > 0:
+            summary += ', %i pages failed (%s)' % (len(self.failures),
+                                                  ', '.join('page %i: %s' % failure for failure in self.failures))
+        return summary
+
+
+def readBatchFile(batchFile):
+    """
+    Read the albums of a batch file, one input directory per line optionally followed by a tab and its output
+    directory. Empty lines and lines starting with # are ignored.
+    :rtype: list[(str, str)]
+    """
+    directories = []
+    f = open(batchFile, 'r')
+    try:
+        for line in f:
+            line = line.rstrip('\r\n')
+            if line.strip() == '' or line.startswith('#'):
+                continue
+            fields = line.split('\t')
+            if len(fields) > 1:
+                directories.append((fields[0], fields[1]))
+            else:
+                directories.append((fields[0], None))
+    finally:
+        f.close()
+    return directories
+
+
+def getBatchAlbums(directories, outputDirectory):
+    """
+    :param directories: (input directory, output directory or None) of every album
+    :param outputDirectory: directory of the output directories of the albums, named after their input
+    directory, instead of <inputdir>/out. Albums whose input directories share their name get a -2, -3...
+    suffix, in batch order.
+    :return: the albums, the ones whose output directory is already the one of another album having an error
+    :rtype: list[Album]
+    """
+    albums = []
+    # normalized output directory -> album writing to it
+    albumsByOutput = {}
+    for (inputdir, outputdir) in directories:
+        inputdir = inputdir + '/'
+        if outputdir is None:
+            if outputDirectory is not None:
+                name = os.path.basename(os.path.normpath(inputdir))
+                outputdir = os.path.join(outputDirectory, name)
+                suffix = 1
+                while os.path.normpath(outputdir) in albumsByOutput:
+                    suffix += 1
+                    outputdir = os.path.join(outputDirectory, '%s-%i' % (name, suffix))
+                if suffix > 1:
+                    logger.warning("Album '%s' written to %s, another album having the same name" %
+                                   (inputdir, outputdir))
+            else:
+                outputdir = inputdir + '/out'
+        album = Album(inputdir, outputdir + '/')
+        other = albumsByOutput.get(os.path.normpath(outputdir))
+        if other is not None:
+            album.error = "its output directory %s is also the one of album '%s'" % (outputdir, other.inputdir)
+        else:
+            albumsByOutput[os.path.normpath(outputdir)] = album
+        albums.append(album)
+    return albums
+
+
+def renderBatch(albums, layouts, args):
+    """
+    Plan every album, then render the pages of all of them with one renderer, largest albums first so that
+    a huge album does not end the batch alone. An album that cannot be planned or rendered does not stop
+    the others.
+    :return: False if some album failed
+    :rtype: bool
+    """
+    for (index, album) in enumerate(albums):
+        if album.error is not None:
+            continue
+        logger.info("Planning album '%s' (%i/%i)" % (album.name, index + 1, len(albums)))
+        try:
+            if not os.path.isdir(album.inputdir):
+                raise IOError('%s is not a directory' % album.inputdir)
+            # Before planning, which saves the manifest of incremental albums in it
+            if not os.path.exists(album.outputdir):
+                os.makedirs(album.outputdir)
+            album.openCaches(args['cache'], args['noCache'])
+            album.plan(layouts, iterChapters(album.inputdir), args['incremental'])
+            for pagePlan in album.pagePlans:
+                pagePlan.album = index
+        except Exception as e:
+            logger.exception("Unable to plan album '%s'" % album.name)
+            album.error = str(e)
+    plannedAlbums = [album for album in albums if album.error is None]
+    if args['planOnly']:
+        for album in albums:
+            if album.error is None:
+                logger.info("Album '%s' planned in %i pages" % (album.name, len(album.pagePlans) + 1))
+            else:
+                logger.error(album.getSummary())
+        if args.get('plan') is not None:
+            writePlanReport(args['plan'], [row for album in plannedAlbums for row in album.getPlanRows(layouts)])
+        return len(plannedAlbums) == len(albums)
+
+    (pool, workerState) = (args.get('pool'), None)
+    if pool is not None:
+        workerState = getWorkerState(args['config'], albums, args['cache'], args['noCache'])
+    renderer = PageRenderer(layouts, args['jobs'], albums, pool, workerState)
+    for album in sorted(plannedAlbums, key=lambda album: -len(album.plansToRender)):
+        renderer.submit(album.plansToRender)
+    for album in plannedAlbums:
+        if album.mustRenderIndex:
+            album.activate()
+            try:
+                album.renderIndexPage()
+            except Exception as e:
+                logger.exception("Unable to render the index of album '%s'" % album.name)
+                album.failures.append((0, str(e)))
+    renderer.finish()
+
+    success = True
+    for album in albums:
+        if album.error is None:
+            album.finish()
+        if album.error is not None or len(album.failures) > 0 or not album.complete:
+            logger.error(album.getSummary())
+            success = False
+        else:
+            logger.info(album.getSummary())
+    logger.info('%i/%i albums rendered without error' % (len([album for album in albums if album.error is None
+                                                                and len(album.failures) == 0 and album.complete]),
+                                                           len(albums)))
+    return success
+
+
+workerLayouts = None
+# Albums of the pages in batch mode
+workerAlbums = None
+# Where workers dump their cProfile statistics, when enabled
+profilerDirectory = None
+# Job state the layouts and albums of a worker of a shared pool have been built from, see getWorkerState
+workerState = None
+# Caches of the albums rendered by a worker of a shared pool, by (input directory, cache file, noCache)
+workerCaches = {}
+
+
+def createRenderPool(jobs):
+    """
+    Pool of jobs processes rendering the pages of every batch of a long-running process, to create before the
+    process starts any thread. Its workers build the layouts and albums of a batch from the state sent with its
+    pages, see getWorkerState.
+    """
+    return multiprocessing.Pool(jobs, initRenderWorker, (None,))
+
+
+def getWorkerState(configValues, albums, cacheFile, noCache):
+    """
+    :param configValues: values the layouts of the batch have been built from, see readConfigValues
+    :return: the pickled state of a batch, from which the workers of a shared pool rebuild its layouts and albums
+    :rtype: str
+    """
+    directories = []
+    for album in albums:
+        if album.error is None:
+            directories.append((album.inputdir, album.outputdir))
+        else:
+            directories.append(None)
+    return cPickle.dumps((configValues, directories, cacheFile, noCache), cPickle.HIGHEST_PROTOCOL)
+
+
+def initRenderWorker(layouts, albums=None):
+    global workerLayouts, workerAlbums
+    workerLayouts = layouts
+    workerAlbums = albums
+    # Forget the timings inherited from the main process, they are reported by it
+    profiler.reset()
+    profiler.cProfiles = {}
+
+
+def setWorkerState(state):
+    """
+    Rebuild the layouts and albums of a batch in a worker of a shared pool, reusing the caches of the albums
+    it has already rendered
+    """
+    global workerState, workerLayouts, workerAlbums
+    (configValues, directories, cacheFile, noCache) = cPickle.loads(state)
+    (properties, workerLayouts) = buildConfig(configValues)
+    imageMemory.setBudget(properties.memoryBudgetMB)
+    # Drawn with the configuration of the previous batch
+    PageTemplates.templates.clear()
+    workerAlbums = []
+    for albumDirectories in directories:
+        if albumDirectories is None:
+            workerAlbums.append(None)
+            continue
+        album = Album(*albumDirectories)
+        key = (album.inputdir, cacheFile, noCache)
+        if key not in workerCaches:
+            album.openCaches(cacheFile, noCache)
+            workerCaches[key] = (album.metadataCache, album.derivedImageCache, album.textImageCache)
+        (album.metadataCache, album.derivedImageCache, album.textImageCache) = workerCaches[key]
+        if album.metadataCache is not None:
+            # Files may have changed since the previous batch
+            album.metadataCache.checked.clear()
+        workerAlbums.append(album)
+    workerState = state
+
+
+def renderPageInWorker(pagePlan, state=None):
+    """
+    :param state: state of the batch of the page in a shared pool, see getWorkerState
+    :return: the number of pictures inserted in the page, the timings of the worker since its previous page
+    and the peak memory of its decoded images
+    """
+    if state is not None and state != workerState:
+        setWorkerState(state)
+    if pagePlan.album is not None:
+        workerAlbums[pagePlan.album].activate()
+    inserted = renderPage(pagePlan, workerLayouts)
+    if profiler.cProfileEnabled:
+        profiler.dumpCProfiles(profilerDirectory, '-%i' % os.getpid())
+    return inserted, profiler.takeReport(), imageMemory.peakMemory
+
+
+class PageRenderer:
+    """
+    Render planned pages as soon as they are submitted, in a pool of jobs processes if jobs > 1.
+    Every page is rendered by the same code whatever the number of jobs, so the output does not depend on it.
+    Without a pool, the images of the next pages are prepared by an ImagePrefetcher and pages are encoded
+    by a PageWriter while the next ones are composed, worker processes do both themselves.
+    In batch mode, pages of several albums are rendered and the failure of a page is reported to its album
+    instead of stopping the others.
+    """
+    def __init__(self, layouts, jobs=1, albums=None, pool=None, workerState=None):
+        """
+        :param albums: the albums of the pages in batch mode, None to render a single album
+        :type albums: list[Album]
+        :param pool: pool shared with the other renderers of the process, see createRenderPool, None to create
+        one for this renderer
+        :param workerState: state of the batch sent with its pages to the shared pool, see getWorkerState
+        """
+        self.layouts = layouts
+        self.jobs = jobs
+        self.albums = albums
+        self.pool = pool
+        self.sharedPool = pool is not None
+        self.workerState = workerState
+        self.results = []
+        self.pageWriter = None
+        self.prefetcher = None
+        # output path -> plan, for the pages being encoded in batch mode
+        self.writing = {}
+        # Pages are reported to their album by the encoder threads
+        self.albumsLock = threading.Lock()
+
+    def submit(self, pagePlans):
+        if self.jobs > 1:
+            for pagePlan in pagePlans:
+                if self.pool is None:
+                    logger.info('Rendering pages with %i jobs' % self.jobs)
+                    self.pool = multiprocessing.Pool(self.jobs, initRenderWorker, (self.layouts, self.albums))
+                self.results.append((pagePlan, self.pool.apply_async(renderPageInWorker,
+                                                                     (pagePlan, self.workerState))))
+            return
+        pageProperties = self.layouts[0].pageProperties
+        if self.pageWriter is None:
+            if self.albums is None:
+                (onError, onWritten) = (None, None)
+            else:
+                (onError, onWritten) = (self.pageWriteFailed, self.pageWritten)
+            self.pageWriter = PageWriter(pageProperties.outputOptions, pageProperties.outputEncoders,
+                                         pageProperties.outputQueueSize, onError, onWritten)
+        if self.prefetcher is None and pageProperties.prefetchPages > 0:
+            self.prefetcher = ImagePrefetcher(self.layouts, pageProperties.prefetchPages,
+                                              pageProperties.prefetchMemoryMB, pageProperties.prefetchThreads)
+        if self.prefetcher is not None:
+            self.prefetcher.schedule(pagePlans)
+        for pagePlan in pagePlans:
+            if self.albums is None:
+                renderPage(pagePlan, self.layouts, self.pageWriter, self.prefetcher)
+                continue
+            self.albums[pagePlan.album].activate()
+            with self.albumsLock:
+                self.writing[pagePlan.getOutputPath()] = pagePlan
+            try:
+                renderPage(pagePlan, self.layouts, self.pageWriter, self.prefetcher)
+            except Exception as e:
+                logger.exception("Unable to render page %i of album '%s'" % (pagePlan.page,
+                                                                            self.albums[pagePlan.album].name))
+                with self.albumsLock:
+                    # Still there unless the page was written before the error
+                    if self.writing.pop(pagePlan.getOutputPath(), None) is not None:
+                        self.pageFailed(pagePlan, e)
+
+    def pageWritten(self, path):
+        """
+        Report a page to its album once written by the PageWriter, rather than once composed
+        """
+        with self.albumsLock:
+            pagePlan = self.writing.pop(path)
+            self.albums[pagePlan.album].pageRendered(pagePlan)
+
+    def pageWriteFailed(self, path, error):
+        with self.albumsLock:
+            self.pageFailed(self.writing.pop(path), error)
+
+    def pageFailed(self, pagePlan, error):
+        if self.albums is None:
+            raise error
+        self.albums[pagePlan.album].failures.append((pagePlan.page, str(error)))
+
+    def finish(self):
+        """
+        Wait for the pages rendered by the pool or still being encoded
+        """
+        if self.prefetcher is not None:
+            self.prefetcher.close()
+            self.prefetcher = None
+        if self.pageWriter is not None:
+            self.pageWriter.close()
+            self.pageWriter = None
+        self.writing = {}
+        if self.pool is None:
+            return
+        if self.sharedPool:
+            # Left running for the next renderers
+            try:
+                self.collectResults()
+            finally:
+                self.results = []
+            return
+        try:
+            self.collectResults()
+            self.pool.close()
+        except:
+            self.pool.terminate()
+            raise
+        finally:
+            self.pool.join()
+            self.pool = None
+            self.results = []
+
+    def collectResults(self):
+        for (pagePlan, result) in self.results:
+            try:
+                (inserted, report, peakMemory) = result.get()
+            except Exception as e:
+                self.pageFailed(pagePlan, e)
+                continue
+            Layout.allPicturesInserted += inserted
+            profiler.merge(report)
+            imageMemory.peakMemory = max(imageMemory.peakMemory, peakMemory)
+            if self.albums is not None:
+                self.albums[pagePlan.album].pageRendered(pagePlan)
+
+
 class PageProperties:
     pass
 
 pageProperties = PageProperties()
 
 
-def parseConfig(configFile):
-    logger.info("Parsing configuration")
+def parseConfig(configFile, overrides=None):
+    """
+    :param overrides: values replacing the ones of the configuration file, by 'section.option'
+    :type overrides: dict[str, str]
+    """
+    return buildConfig(readConfigValues(configFile, overrides))
+
+
+def readConfigValues(configFile, overrides=None):
+    """
+    Read the values of the configuration file, without interpreting them
+    :return: (section, [(option, value)]) of every section, in file order
+    :rtype: list[tuple]
+    """
     config = ConfigParser.RawConfigParser()
     config.read(configFile)
+    if overrides is not None:
+        for (key, value) in overrides.items():
+            (section, option) = key.split('.', 1)
+            if not config.has_section(section):
+                config.add_section(section)
+            config.set(section, option, str(value))
+    return [(section, config.items(section)) for section in config.sections()]
+
+
+def buildConfig(values):
+    """
+    Set the page properties and build the layouts from the values read by readConfigValues
+    """
+    logger.info("Parsing configuration")
+    config = ConfigParser.RawConfigParser()
+    for (section, options) in values:
+        config.add_section(section)
+        for (option, value) in options:
+            config.set(section, option, value)
     layouts = []
     pageProperties.finalImageResolution = Size(config.get('general', 'finalImage.resolution'))
     pageProperties.finalImageFont = config.get('general', 'finalImage.font')
@@ -514,40 +1923,169 @@ def parseConfig(configFile):
     pageProperties.bookmarkFont = config.get('general', 'index.bookmark.font')
     pageProperties.bookmarkFontSize = config.getint('general', 'index.bookmark.fontSize')
     pageProperties.bookmarkMaxLength = config.getint('general', 'index.bookmark.maxLength')
+    # Decode JPEG files at the smallest scale covering their target size, see ImageAndPath.setDecodeSize
+    pageProperties.draftDecoding = True
     pageProperties.indexColors = [ ]
     for colors in config.get('general',  'index.colors').split(','):
         pageProperties.indexColors.append(colors.strip())
+    # Parsed once rather than by PIL for every drawing
+    pageProperties.backgroundColorRGB = getRGBColor(pageProperties.finalImageBackgroundColor)
+    pageProperties.indexColorsRGB = [getRGBColor(color) for color in pageProperties.indexColors]
+    # Drawn with the previous properties, when a long-running process parses the configuration again
+    PageTemplates.templates.clear()
 
     for section in config.sections():
         if section.startswith('layout-'):
             l = Layout(section, pageProperties)
             layouts.append(l)
-            slotsText = [None]*3
-            for option in config.options(section):
-                if option == 'photo.0':
-                    slotsText[0] = option
-                elif option == 'photo.1':
-                    slotsText[1] = option
-                elif option == 'photo.2':
-                    slotsText[2] = option
+            # photo.0, photo.1, ... in slot order, whatever their number
+            slotsText = sorted([option for option in config.options(section) if re.match(r'photo\.\d+$', option)],
+                               key=lambda option: int(option.split('.')[1]))
+            if config.has_option(section, 'cost'):
+                l.cost = config.getfloat(section, 'cost')
             for label in slotsText:
-                if label != None:
-                    values = config.get(section, label).split(',')
-                    l.addSlot(values[0].strip(), Size(values[1].strip()), Size(values[2].strip()))
+                values = config.get(section, label).split(',')
+                l.addSlot(values[0].strip(), Size(values[1].strip()), Size(values[2].strip()))
+
+    pageProperties.outputOptions = OutputOptions()
+    pageProperties.outputEncoders = 2
+    pageProperties.outputQueueSize = 2
+    pageProperties.mappedCanvas = False
+    pageProperties.canvasStripHeight = 512
+    if config.has_section('output'):
+        if config.has_option('output', 'format'):
+            pageProperties.outputOptions.format = config.get('output', 'format').upper()
+        if config.has_option('output', 'quality'):
+            pageProperties.outputOptions.quality = config.getint('output', 'quality')
+        if config.has_option('output', 'subsampling'):
+            pageProperties.outputOptions.subsampling = config.getint('output', 'subsampling')
+        if config.has_option('output', 'progressive'):
+            pageProperties.outputOptions.progressive = config.getboolean('output', 'progressive')
+        if config.has_option('output', 'encoders'):
+            pageProperties.outputEncoders = config.getint('output', 'encoders')
+        if config.has_option('output', 'queue'):
+            pageProperties.outputQueueSize = config.getint('output', 'queue')
+        if config.has_option('output', 'canvas'):
+            pageProperties.mappedCanvas = config.get('output', 'canvas') == 'mapped'
+        if config.has_option('output', 'canvas.stripHeight'):
+            pageProperties.canvasStripHeight = config.getint('output', 'canvas.stripHeight')
+
+    pageProperties.prefetchPages = 4
+    pageProperties.prefetchMemoryMB = 512
+    pageProperties.prefetchThreads = 2
+    if config.has_section('prefetch'):
+        if config.has_option('prefetch', 'pages'):
+            pageProperties.prefetchPages = config.getint('prefetch', 'pages')
+        if config.has_option('prefetch', 'memory'):
+            pageProperties.prefetchMemoryMB = config.getint('prefetch', 'memory')
+        if config.has_option('prefetch', 'threads'):
+            pageProperties.prefetchThreads = config.getint('prefetch', 'threads')
+
+    pageProperties.memoryBudgetMB = 0
+    if config.has_option('memory', 'budget'):
+        pageProperties.memoryBudgetMB = config.getint('memory', 'budget')
+
+    pageProperties.derivedCacheMaxSizeMB = 2048
+    if config.has_option('cache', 'resized.maxSize'):
+        pageProperties.derivedCacheMaxSizeMB = config.getint('cache', 'resized.maxSize')
+    pageProperties.textCacheMaxSizeMB = 256
+    if config.has_option('cache', 'text.maxSize'):
+        pageProperties.textCacheMaxSizeMB = config.getint('cache', 'text.maxSize')
 
     logger.info("Parsing done")
-    return pageProperties, layouts
+    return pageProperties, LayoutIndex(layouts)
+
+
+# To increase whenever the content of configuration snapshots changes
+CONFIG_SNAPSHOT_VERSION = 4
+
+
+def getConfigSnapshotPath(configFile):
+    (directory, name) = os.path.split(configFile)
+    return os.path.join(directory, '.%s.snapshot' % name)
+
+
+def loadConfig(configFile):
+    """
+    Same as parseConfig, reusing the values read by the previous run, saved in a snapshot next to the
+    configuration file, as long as the file is unchanged. The snapshot only holds plain values, so that it does
+    not depend on the module albumMaker is run as.
+    """
+    try:
+        f = open(configFile, 'rb')
+        try:
+            digest = hashlib.sha1(f.read()).hexdigest()
+        finally:
+            f.close()
+    except IOError:
+        return parseConfig(configFile)
+    snapshotPath = getConfigSnapshotPath(configFile)
+    if os.path.exists(snapshotPath):
+        try:
+            f = open(snapshotPath, 'rb')
+            try:
+                (version, snapshotDigest, values) = cPickle.load(f)
+            finally:
+                f.close()
+            if (version, snapshotDigest) == (CONFIG_SNAPSHOT_VERSION, digest):
+                logger.info('Configuration loaded from snapshot %s' % snapshotPath)
+                return buildConfig(values)
+        except Exception as e:
+            # Unpickling a snapshot written by another version can fail in many ways
+            logger.warning('Unable to read configuration snapshot %s (%s)' % (snapshotPath, e))
+
+    values = readConfigValues(configFile)
+    temporaryPath = '%s.tmp-%i' % (snapshotPath, os.getpid())
+    try:
+        f = open(temporaryPath, 'wb')
+        try:
+            cPickle.dump((CONFIG_SNAPSHOT_VERSION, digest, values), f, cPickle.HIGHEST_PROTOCOL)
+        finally:
+            f.close()
+        os.rename(temporaryPath, snapshotPath)
+    except (IOError, OSError) as e:
+        logger.warning('Unable to write configuration snapshot %s (%s)' % (snapshotPath, e))
+        if os.path.exists(temporaryPath):
+            os.remove(temporaryPath)
+    return buildConfig(values)
 
 
 def main():
+    global profilerDirectory
     parser = argparse.ArgumentParser(description='Make album from single photos')
-    parser.add_argument('inputdir', nargs=1)
-    parser.add_argument('-o', '--out', dest='outputDirectory')
+    parser.add_argument('inputdir', nargs='*')
+    parser.add_argument('-o', '--out', dest='outputDirectory',
+    help='output directory, or directory of the output directories of the albums with several input directories')
+    parser.add_argument('--batch', dest='batch',
+    help='file listing the input directories of the albums to render, one per line, each optionally followed '
+    'by a tab and its output directory')
     parser.add_argument('--testBlack', dest='testBlack', action='store_const', const=True,
     default=False)
     parser.add_argument('--testChapter', dest='testChapter', action='store_const', const=True,
     default=False)
     parser.add_argument('--debug', action='store_const', const=True, default=False)
+    parser.add_argument('--cache', dest='cache',
+    help='metadata cache file, text images and resized photos being cached in the <cache file without '
+    'extension>-text and -resized directories (default: <inputdir>/.albumMaker-cache.sqlite)')
+    parser.add_argument('--no-cache', dest='noCache', action='store_const', const=True, default=False,
+    help='do not read nor write the metadata cache, the cached text images and resized photos')
+    parser.add_argument('--incremental', dest='incremental', action='store_const', const=True, default=False,
+    help='only render the pages whose inputs changed since the previous run in the output directory')
+    parser.add_argument('--full-decode', dest='fullDecode', action='store_const', const=True, default=False,
+    help='always decode photos at full resolution before resizing them')
+    parser.add_argument('--memory-budget', dest='memoryBudget', type=int,
+    help='MB of decoded images kept by each process at most (default: budget of the [memory] section)')
+    parser.add_argument('-j', '--jobs', dest='jobs', type=int, default=1,
+    help='number of worker processes used to render pages')
+    parser.add_argument('--plan-only', dest='planOnly', action='store_const', const=True, default=False,
+    help='only plan the pages, without rendering them')
+    parser.add_argument('--plan', dest='plan',
+    help='only plan the pages, and write the plan with the estimated cost of every page to this CSV '
+    '(.csv extension) or JSON file')
+    parser.add_argument('--timings', dest='timings',
+    help='write the time and memory spent per phase and per page to this JSON file')
+    parser.add_argument('--profile', dest='profile',
+    help='write a cProfile dump per phase in this directory')
     args = vars(parser.parse_args())
 
     logger.addHandler(ColorizingStreamHandler())
@@ -560,7 +2098,33 @@ def main():
 
     logger.info("Starting albumMaker")
 
-    inputdir = args['inputdir'][0] + '/'
+    if args['timings'] != None or args['profile'] != None:
+        profiler.enable(args['profile'] != None)
+        profilerDirectory = args['profile']
+
+    if args['plan'] != None:
+        args['planOnly'] = True
+    directories = [(inputdir, None) for inputdir in args['inputdir']]
+    if args['batch'] != None:
+        directories += readBatchFile(args['batch'])
+    if len(directories) == 0:
+        parser.error('no input directory')
+
+    (pageProperties, layouts) = loadConfig('configuration.cfg')
+    pageProperties.draftDecoding = not args['fullDecode']
+    if args['memoryBudget'] != None:
+        pageProperties.memoryBudgetMB = args['memoryBudget']
+    imageMemory.setBudget(pageProperties.memoryBudgetMB)
+
+    if len(directories) > 1 or args['batch'] != None:
+        success = renderBatch(getBatchAlbums(directories, args['outputDirectory']), layouts, args)
+        reportProfile(args)
+        logger.info(imageMemory.summary())
+        if not success:
+            sys.exit(1)
+        return
+
+    inputdir = directories[0][0] + '/'
     if args['outputDirectory'] != None:
         outputdir = args['outputDirectory'] + '/'
     else:
@@ -569,8 +2133,6 @@ def main():
     logger.info("   inputdir = %s" % inputdir)
     logger.info("   outputdir = %s" % outputdir)
 
-    (pageProperties, layouts) = parseConfig('configuration.cfg')
-
     if args['testBlack']:
         imgv = ImageAndPath("ressources/blackv.jpg")
         imgh = ImageAndPath("ressources/blackh.jpg")
@@ -598,60 +2160,50 @@ def main():
         for i in range(0, 21):
             chapters[i] = img
             chapterList[i] = 'Chapitre %i' % i
-    else:
-        chapterList = {}
-        chapters = {}
 
-        allimages = []
-        for filename in natsorted(os.listdir(inputdir)):
-            if filename.lower().endswith('.jpg') or filename.lower().endswith('.txt'):
-                allimages.append(ImageAndPath(inputdir + filename))
-        for i in allimages:
-            print i.getPath()
-            id = re.match(r'.*/(?P<chapter>\d+) *- *(?P<chapterName>.*)\((?P<number>\d+)\).*', i.getPath()).groupdict()
-            if not chapters.has_key(int(id['chapter'])):
-                chapters[int(id['chapter'])] = []
-                chapterList[int(id['chapter'])] = id['chapterName'].strip().decode('utf-8')
-            chapters[int(id['chapter'])].append(i)
-
-    logger.info('Starting index rendering')
-    page = 0
-    pageImage = getNewPageImage(pageProperties)
-    renderIndex(pageImage, chapterList, chapters, pageProperties)
-    pageImage.save('%s/page-%i.jpg' % (outputdir, page), 'JPEG', quality=99)
-    logger.info('Index rendered')
-
-    page = 1
-    for chapterNumber in chapters:
-        images = chapters[chapterNumber]
-        chapterName = chapterList[chapterNumber]
-        logger.info(" ** Starting chapter '%s'" % chapterName)
-        index = 0
-        while index < len(images):
-            logger.info('   > Starting rendering page %i' % page)
-            pageImage = getNewPageImage(pageProperties)
-
-            if index == 0:
-                drawBookmark(pageImage, chapterNumber, chapterName, pageProperties)
-            else:
-                drawBookmark(pageImage, chapterNumber, '', pageProperties)
-
-            (imageNumber, compatibleLayout) = Layout.getCompatibleLayout(layouts, images[index:])
-            if compatibleLayout is None:
-                logging.error('No layout compatible found')
-                return
-
-            #compatibleLayout.render(pageImage, images[index:index+imageNumber])
-
-            pageImage.save('%s/page-%i.jpg' % (outputdir, page), 'JPEG', quality=99)
-
-            logger.info(' ==> Page %i has been rendered with image %i to %i with layout %s' %
-                        (page, index, index + imageNumber, compatibleLayout.name))
+    if args['testBlack'] or args['testChapter']:
+        chapterStream = [(chapterNumber, chapterList[chapterNumber], chapters[chapterNumber])
+                         for chapterNumber in chapters]
+    else:
+        chapterStream = iterChapters(inputdir)
+
+    album = Album(inputdir, outputdir)
+    album.openCaches(args['cache'], args['noCache'])
+    if args['planOnly']:
+        album.plan(layouts, chapterStream, False)
+        if args['plan'] != None:
+            writePlanReport(args['plan'], album.getPlanRows(layouts))
+        reportProfile(args)
+        if not album.complete:
+            logger.error('Some images fit no layout and were left out')
+        logger.info('%i pages planned' % (len(album.pagePlans) + 1))
+        return
+
+    # Pages of a chapter are rendered while the next chapters are scanned and planned
+    renderer = PageRenderer(layouts, args['jobs'])
+    album.plan(layouts, chapterStream, args['incremental'], renderer)
+    if album.mustRenderIndex:
+        album.renderIndexPage()
+    renderer.submit(album.plansToRender)
+    renderer.finish()
+    album.finish()
+
+    reportProfile(args)
+    logger.info(imageMemory.summary())
+    if not album.complete:
+        logger.error('Some images fit no layout and were left out')
+    logger.info('%i pictures has been rendered in %i pages' % (Layout.allPicturesInserted, len(album.pagePlans) + 1))
+
+
+def reportProfile(args):
+    if profiler.enabled:
+        for line in profiler.summary():
+            logger.info(line)
+        if args['timings'] != None:
+            profiler.save(args['timings'])
+        if args['profile'] != None:
+            profiler.dumpCProfiles(args['profile'])
 
-            page += 1
-            index += imageNumber
-    logger.info('%i pictures has been rendered in %i pages' % (Layout.allPicturesInserted, page))
-    
 if __name__ == "__main__":
     main()
 
@@ -0,0 +1,309 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2012 Sebastien Baguet. All rights reserved. Licensed under the new BSD license.
+#
+"""
+Rendering benchmark: generate a synthetic album, time every phase of its
+rendering and compare the result with a baseline.
+
+    ./benchmark.py --photos 200 --save-baseline baseline.json
+    ./benchmark.py --photos 200 --baseline baseline.json --threshold 0.2
+
+The exit code is 1 when a phase is slower, the throughput lower or the peak
+memory higher than the baseline by more than the threshold.
+"""
+
+import argparse
+import json
+import logging
+import os
+import random
+import resource
+import shutil
+import struct
+import sys
+import tempfile
+import time
+from StringIO import StringIO
+from PIL import Image, ImageDraw
+
+import albumMaker
+
+logger = logging.getLogger('albumMaker')
+
+PHASES = ['scan', 'metadata', 'layout', 'index', 'render', 'encode']
+
+WORDS = ('lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor incididunt ut labore '
+         'et dolore magna aliqua ut enim ad minim veniam quis nostrud exercitation ullamco laboris nisi').split()
+
+
+def makeSegment(marker, payload):
+    return '\xff' + chr(marker) + struct.pack('>H', len(payload) + 2) + payload
+
+
+def makeExifSegment(orientation):
+    """
+    APP1 segment holding a little-endian TIFF IFD0 with only the Orientation tag
+    """
+    tiff = 'II*\x00' + struct.pack('<I', 8)
+    tiff += struct.pack('<H', 1) + struct.pack('<HHIHH', 0x0112, 3, 1, orientation, 0) + struct.pack('<I', 0)
+    return makeSegment(0xE1, 'Exif\x00\x00' + tiff)
+
+
+def makeIptcSegment(caption):
+    """
+    APP13 segment holding an IPTC Caption/Abstract (2:120) record
+    """
+    iptc = '\x1c\x02\x78' + struct.pack('>H', len(caption)) + caption
+    if len(iptc) % 2:
+        padding = '\x00'
+    else:
+        padding = ''
+    resource = '8BIM' + struct.pack('>H', 0x0404) + '\x00\x00' + struct.pack('>I', len(iptc)) + iptc + padding
+    return makeSegment(0xED, 'Photoshop 3.0\x00' + resource)
+
+
+def insertSegments(jpegData, segments):
+    """
+    Insert segments after the SOI marker and the JFIF APP0 segment, if any
+    """
+    position = 2
+    if jpegData[2:4] == '\xff\xe0':
+        position = 4 + struct.unpack('>H', jpegData[4:6])[0]
+    return jpegData[:position] + ''.join(segments) + jpegData[position:]
+
+
+def makeText(rand, length):
+    text = 'h1. ' + ' '.join(rand.choice(WORDS) for i in range(4)) + '\n'
+    while len(text) < length:
+        text += rand.choice(WORDS) + ' '
+        if rand.random() < 0.02:
+            text += '\n'
+    return text
+
+
+def makePhoto(rand, size):
+    image = Image.new('RGB', size, (rand.randint(0, 255), rand.randint(0, 255), rand.randint(0, 255)))
+    draw = ImageDraw.Draw(image)
+    # Some detail, so that the photos are not trivial to encode and decode
+    for i in range(40):
+        x = rand.randint(0, size[0])
+        y = rand.randint(0, size[1])
+        draw.rectangle([(x, y), (x + rand.randint(10, size[0] / 4), y + rand.randint(10, size[1] / 4))],
+                       fill=(rand.randint(0, 255), rand.randint(0, 255), rand.randint(0, 255)))
+    output = StringIO()
+    image.save(output, 'JPEG', quality=90)
+    return output.getvalue()
+
+
+def generateAlbum(directory, options):
+    """
+    Write a synthetic input directory following the '<chapter> - <name> (<number>).jpg|txt' naming
+    """
+    rand = random.Random(options.seed)
+    (longSide, shortSide) = [int(v) for v in options.resolution.split('x')]
+    # A few distinct photos per orientation are enough, they are written under many names
+    photos = {}
+    for orientation in ('h', 'v'):
+        photos[orientation] = []
+        for i in range(4):
+            if orientation == 'h':
+                photos[orientation].append(makePhoto(rand, (longSide, shortSide)))
+            else:
+                photos[orientation].append(makePhoto(rand, (shortSide, longSide)))
+
+    number = 0
+    for chapter in range(1, options.chapters + 1):
+        for i in range(options.photos / options.chapters):
+            number += 1
+            segments = []
+            if rand.random() < options.exifRatio:
+                # Stored landscape, displayed portrait
+                data = rand.choice(photos['h'])
+                segments.append(makeExifSegment(rand.choice([6, 8])))
+            elif rand.random() < options.verticalRatio:
+                data = rand.choice(photos['v'])
+            else:
+                data = rand.choice(photos['h'])
+            if rand.random() < options.captionRatio:
+                segments.append(makeIptcSegment(' '.join(rand.choice(WORDS) for w in range(rand.randint(3, 12)))))
+            f = open(os.path.join(directory, '%i - Chapter %i (%i).jpg' % (chapter, chapter, number)), 'wb')
+            f.write(insertSegments(data, segments))
+            f.close()
+        for i in range(options.texts):
+            number += 1
+            f = open(os.path.join(directory, '%i - Chapter %i (%i).txt' % (chapter, chapter, number)), 'w')
+            f.write(makeText(rand, options.textLength))
+            f.close()
+
+
+def runBenchmark(inputdir, outputdir, configFile):
+    phases = dict((phase, 0.) for phase in PHASES)
+    albumMaker.metadataCache = None
+    (pageProperties, layouts) = albumMaker.parseConfig(configFile)
+    albumMaker.imageMemory.setBudget(pageProperties.memoryBudgetMB)
+
+    start = time.time()
+    (chapters, chapterList) = albumMaker.scanInputDirectory(inputdir)
+    phases['scan'] = time.time() - start
+
+    start = time.time()
+    megapixels = 0.
+    images = 0
+    for chapterNumber in chapters:
+        for imageAndPath in chapters[chapterNumber]:
+            images += 1
+            if imageAndPath.getType() == albumMaker.ImageAndPath.IMAGE:
+                header = imageAndPath.probe()
+                imageAndPath.getCaption()
+                megapixels += header[0] * header[1] / 1000000.
+            else:
+                imageAndPath.getTextHeight()
+    phases['metadata'] = time.time() - start
+
+    start = time.time()
+    (pagePlans, complete) = albumMaker.planPages(layouts, chapters, chapterList, outputdir)
+    phases['layout'] = time.time() - start
+    if not complete:
+        logger.error('The synthetic album could not be fully laid out')
+
+    start = time.time()
+    pageImage = albumMaker.getNewPageImage(pageProperties)
+    albumMaker.renderIndex(pageImage, chapterList, chapters, pageProperties)
+    phases['index'] = time.time() - start
+    start = time.time()
+    albumMaker.saveImage(pageImage, albumMaker.getPageOutputPath(outputdir, 0), pageProperties.outputOptions)
+    phases['encode'] += time.time() - start
+
+    for pagePlan in pagePlans:
+        start = time.time()
+        pageImage = albumMaker.composePage(pagePlan, layouts)
+        phases['render'] += time.time() - start
+        start = time.time()
+        albumMaker.saveImage(pageImage, pagePlan.getOutputPath(), pageProperties.outputOptions)
+        phases['encode'] += time.time() - start
+
+    total = sum(phases.values())
+    pages = len(pagePlans) + 1
+    return {
+        'phases': phases,
+        'images': images,
+        'pages': pages,
+        'megapixels': megapixels,
+        'seconds': total,
+        'pagesPerSecond': pages / total,
+        'megapixelsPerSecond': megapixels / (phases['index'] + phases['render']),
+        # kilobytes on Linux
+        'peakMemoryMB': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.,
+        'peakDecodedMB': albumMaker.imageMemory.peakMemory / 1024. / 1024.,
+    }
+
+
+def getRenderSeconds(results):
+    """
+    :return: the time megapixelsPerSecond is computed from
+    """
+    return results['phases']['index'] + results['phases']['render']
+
+
+def isSlower(seconds, baselineSeconds, threshold, minDelta):
+    return seconds > baselineSeconds * (1 + threshold) and seconds - baselineSeconds > minDelta
+
+
+def compareWithBaseline(results, baseline, threshold, minDelta=0.05):
+    """
+    :param minDelta: seconds a phase can be slower than in the baseline whatever the threshold, so that phases
+    taking milliseconds are not flagged because of timing noise
+    :return: a description of every regression beyond the threshold
+    :rtype: list[str]
+    """
+    regressions = []
+    for phase in PHASES:
+        if phase in baseline['phases'] and isSlower(results['phases'][phase], baseline['phases'][phase], threshold,
+                                                    minDelta):
+            regressions.append('%s phase took %.3fs instead of %.3fs' % (phase, results['phases'][phase],
+                                                                         baseline['phases'][phase]))
+    for (metric, getSeconds) in (('pagesPerSecond', lambda r: r['seconds']),
+                                 ('megapixelsPerSecond', getRenderSeconds)):
+        if results[metric] < baseline[metric] / (1 + threshold) and \
+                getSeconds(results) - getSeconds(baseline) > minDelta:
+            regressions.append('%s is %.3f instead of %.3f' % (metric, results[metric], baseline[metric]))
+    if results['peakMemoryMB'] > baseline['peakMemoryMB'] * (1 + threshold):
+        regressions.append('peak memory is %.1fMB instead of %.1fMB' % (results['peakMemoryMB'],
+                                                                       baseline['peakMemoryMB']))
+    return regressions
+
+
+def printResults(results):
+    print '%i images, %.1f megapixels, %i pages in %.3fs' % (results['images'], results['megapixels'],
+                                                             results['pages'], results['seconds'])
+    for phase in PHASES:
+        print '  %-10s %8.3fs' % (phase, results['phases'][phase])
+    print '  %.2f pages/s, %.2f MP/s, peak memory %.1fMB, peak decoded images %.1fMB' % (
+        results['pagesPerSecond'], results['megapixelsPerSecond'], results['peakMemoryMB'], results['peakDecodedMB'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark albumMaker on a synthetic album')
+    parser.add_argument('--config', default='configuration.cfg')
+    parser.add_argument('--chapters', type=int, default=4)
+    parser.add_argument('--photos', type=int, default=40, help='number of photos, spread over the chapters')
+    parser.add_argument('--resolution', default='3000x2000', help='long x short side of the photos')
+    parser.add_argument('--vertical-ratio', dest='verticalRatio', type=float, default=0.3)
+    parser.add_argument('--exif-ratio', dest='exifRatio', type=float, default=0.2,
+                        help='ratio of photos stored landscape with a portrait EXIF orientation')
+    parser.add_argument('--caption-ratio', dest='captionRatio', type=float, default=0.5)
+    parser.add_argument('--texts', type=int, default=1, help='number of .txt pages per chapter')
+    parser.add_argument('--text-length', dest='textLength', type=int, default=900)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workdir', help='directory of the synthetic album, generated only if it does not exist '
+                        'yet and kept after the run (default: a temporary directory)')
+    parser.add_argument('--keep', action='store_const', const=True, default=False,
+                        help='keep the temporary directory of the synthetic album and of the rendered pages')
+    parser.add_argument('--baseline', help='baseline JSON to compare with')
+    parser.add_argument('--save-baseline', dest='saveBaseline', help='write the results as a baseline JSON')
+    parser.add_argument('--threshold', type=float, default=0.2, help='tolerated regression ratio')
+    parser.add_argument('--min-delta', dest='minDelta', type=float, default=0.05,
+                        help='seconds a phase can be slower than in the baseline whatever the threshold')
+    options = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+
+    if options.workdir is not None:
+        workdir = options.workdir
+        if not os.path.exists(workdir):
+            os.makedirs(workdir)
+    else:
+        workdir = tempfile.mkdtemp(prefix='albumMaker-benchmark-')
+    inputdir = os.path.join(workdir, 'input') + '/'
+    outputdir = os.path.join(workdir, 'out') + '/'
+    try:
+        if not os.path.exists(inputdir):
+            os.makedirs(inputdir)
+            generateAlbum(inputdir, options)
+        if not os.path.exists(outputdir):
+            os.makedirs(outputdir)
+
+        results = runBenchmark(inputdir, outputdir, options.config)
+        printResults(results)
+    finally:
+        if options.workdir is None and not options.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    if options.saveBaseline is not None:
+        f = open(options.saveBaseline, 'w')
+        json.dump(results, f, indent=2, sort_keys=True)
+        f.close()
+
+    if options.baseline is not None:
+        f = open(options.baseline, 'r')
+        baseline = json.load(f)
+        f.close()
+        regressions = compareWithBaseline(results, baseline, options.threshold, options.minDelta)
+        for regression in regressions:
+            print 'REGRESSION: ' + regression
+        if len(regressions) > 0:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2012 Sebastien Baguet. All rights reserved. Licensed under the new BSD license.
+#
+"""
+Persistent cache of the resized photos, so that a rerun skips decoding and
+resizing the photos whose file and target size did not change.
+
+Images are keyed by the fingerprint of their source file (path, size, mtime),
+its EXIF rotation, the target size and the resampling, and stored as raw
+pixels: loading one is a single read without any decoding. Files are touched
+when read and the least recently used ones are removed once the cache exceeds
+its size limit, CacheDirectory doing the same for the drawn texts.
+"""
+
+import hashlib
+import logging
+import os
+import threading
+
+from lazyModule import LazyModule
+from profiling import profiler
+
+Image = LazyModule('PIL.Image')
+
+logger = logging.getLogger('albumMaker')
+
+EXTENSION = '.raw'
+
+
+def getImageBytes(image):
+    # tostring was renamed tobytes by Pillow
+    if hasattr(image, 'tobytes'):
+        return image.tobytes()
+    return image.tostring()
+
+
+class CacheDirectory:
+    """
+    Files of a cache directory, named after their key. The least recently used ones are removed once the
+    directory exceeds its size limit.
+    """
+    def __init__(self, directory, extension, maxSizeMB, description):
+        """
+        :param description: what the files are, for the logs
+        """
+        self.directory = directory
+        self.extension = extension
+        self.maxSize = maxSizeMB * 1024 * 1024
+        self.description = description
+        self.lock = threading.Lock()
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        # Bytes of the cached files, listed on the first write only
+        self.size = None
+
+    def getPath(self, key):
+        return os.path.join(self.directory, key + self.extension)
+
+    def listFiles(self):
+        """
+        :return: (mtime, size, path) of every cached file
+        :rtype: list[tuple]
+        """
+        files = []
+        for name in os.listdir(self.directory):
+            if name.endswith(self.extension):
+                path = os.path.join(self.directory, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    # Pruned by another process
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+        return files
+
+    def touch(self, path):
+        """
+        Mark a file read from the cache as the most recently used
+        """
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+
+    def added(self, path):
+        """
+        Account for a file written in the cache, pruning the cache if it exceeds its size limit
+        """
+        size = os.path.getsize(path)
+        with self.lock:
+            if self.size is None:
+                self.size = sum(size for (mtime, size, path) in self.listFiles())
+            else:
+                self.size += size
+            if self.size > self.maxSize:
+                self.prune()
+
+    def prune(self):
+        """
+        Remove the least recently used files until the cache is back to 80% of its size limit
+        """
+        files = sorted(self.listFiles())
+        self.size = sum(size for (mtime, size, path) in files)
+        removed = 0
+        for (mtime, size, path) in files:
+            if self.size <= self.maxSize * 0.8:
+                break
+            try:
+                os.remove(path)
+                removed += 1
+            except OSError:
+                pass
+            self.size -= size
+        logger.info('%i images pruned from the %s cache %s' % (removed, self.description, self.directory))
+
+
+class DerivedImageCache(CacheDirectory):
+    def __init__(self, directory, maxSizeMB=2048):
+        CacheDirectory.__init__(self, directory, EXTENSION, maxSizeMB, 'resized image')
+
+    @staticmethod
+    def getKey(path, fingerprint, orientation, size, resample):
+        return hashlib.sha1(repr((path, tuple(fingerprint), orientation, tuple(size), resample))).hexdigest()
+
+    def get(self, key):
+        """
+        :return: the cached image, None if missing
+        :rtype: Image.Image
+        """
+        path = self.getPath(key)
+        try:
+            f = open(path, 'rb')
+        except IOError:
+            profiler.count('derivedCacheMisses')
+            return None
+        try:
+            with profiler.phase('derivedCacheLoad'):
+                (mode, width, height) = f.readline().split()
+                image = Image.frombuffer(mode, (int(width), int(height)), f.read(), 'raw', mode, 0, 1)
+        except (ValueError, IOError) as e:
+            logger.warning('Unable to read cached image %s (%s)' % (path, e))
+            return None
+        finally:
+            f.close()
+        self.touch(path)
+        profiler.count('derivedCacheHits')
+        return image
+
+    def put(self, key, image):
+        path = self.getPath(key)
+        temporaryPath = '%s.tmp-%i-%i' % (path, os.getpid(), threading.current_thread().ident)
+        try:
+            f = open(temporaryPath, 'wb')
+            try:
+                f.write('%s %i %i\n' % (image.mode, image.size[0], image.size[1]))
+                f.write(getImageBytes(image))
+            finally:
+                f.close()
+            os.rename(temporaryPath, path)
+            self.added(path)
+        except (IOError, OSError) as e:
+            logger.warning('Unable to write cached image %s (%s)' % (path, e))
+            if os.path.exists(temporaryPath):
+                os.remove(temporaryPath)
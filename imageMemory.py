@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2012 Sebastien Baguet. All rights reserved. Licensed under the new BSD license.
+#
+"""
+Accounting of the memory held by decoded images, following the [memory] section of the configuration.
+
+Every ImageAndPath reports its decoded images through update(). When a budget is set and the decoded
+images of the process exceed it, the least recently used ones are evicted: their pixels are dropped and
+decoded again from their file if needed. The image being updated is never evicted, so the budget may be
+exceeded by the images in use at once.
+"""
+
+import collections
+import logging
+import threading
+
+from profiling import profiler
+
+logger = logging.getLogger('albumMaker')
+
+
+class ImageMemory:
+    def __init__(self, budgetMB=0):
+        self.setBudget(budgetMB)
+        self.lock = threading.Lock()
+        # id -> (ImageAndPath, bytes), least recently used first
+        self.images = collections.OrderedDict()
+        self.memory = 0
+        self.peakMemory = 0
+        self.evictions = 0
+
+    def setBudget(self, budgetMB):
+        """
+        :param budgetMB: MB of decoded images kept at most, 0 for no limit
+        """
+        self.budget = budgetMB * 1024 * 1024
+
+    def update(self, imageAndPath):
+        """
+        Account the decoded images of imageAndPath as most recently used, evicting others if over budget
+        """
+        size = imageAndPath.getMemorySize()
+        evicted = []
+        with self.lock:
+            key = id(imageAndPath)
+            if key in self.images:
+                self.memory -= self.images.pop(key)[1]
+            if size > 0:
+                self.images[key] = (imageAndPath, size)
+                self.memory += size
+                self.peakMemory = max(self.peakMemory, self.memory)
+            if self.budget > 0:
+                for otherKey in list(self.images):
+                    if self.memory <= self.budget:
+                        break
+                    if otherKey != key:
+                        (other, otherSize) = self.images.pop(otherKey)
+                        self.memory -= otherSize
+                        evicted.append(other)
+        for other in evicted:
+            logger.debug('Decoded image of %s evicted' % other.getPath())
+            other.evict()
+            self.evictions += 1
+            profiler.count('imagesEvicted')
+
+    def touch(self, imageAndPath):
+        """
+        Mark the decoded images of imageAndPath as most recently used
+        """
+        with self.lock:
+            key = id(imageAndPath)
+            if key in self.images:
+                self.images[key] = self.images.pop(key)
+
+    def summary(self):
+        return 'Decoded images used %.1fMB at most, %i evicted' % (self.peakMemory / 1024. / 1024., self.evictions)
+
+imageMemory = ImageMemory()
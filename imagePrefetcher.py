@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2012 Sebastien Baguet. All rights reserved. Licensed under the new BSD license.
+#
+"""
+Read-ahead of the images of the next planned pages, following the [prefetch] section of the configuration.
+
+While a page is rendered, threads decode, rotate and resize the images of the next pages (PIL releases
+the GIL while decoding and resizing), so that rendering rarely waits on the disk or the JPEG decoder.
+At most pages pages are prepared ahead, and no page is started while the prepared images not yet
+released by the renderer use more than the memory budget.
+"""
+
+import collections
+import logging
+import threading
+
+from profiling import profiler
+
+logger = logging.getLogger('albumMaker')
+
+
+class ImagePrefetcher:
+    def __init__(self, layouts, pages=4, memoryBudgetMB=512, threads=2):
+        """
+        :param layouts: the layouts the pages are planned with
+        :type layouts: LayoutIndex
+        :param pages: number of pages prepared ahead at most
+        :param memoryBudgetMB: memory of the prepared images above which no page is started
+        :param threads: number of threads preparing pages
+        """
+        self.layouts = layouts
+        self.pages = pages
+        self.memoryBudget = memoryBudgetMB * 1024 * 1024
+        self.condition = threading.Condition()
+        # Scheduled pages not started yet, in rendering order
+        self.pending = collections.deque()
+        # Pages are identified by (album, page), page numbers being unique within their album only
+        self.started = set()
+        # (album, page) -> images, None if they could not be prepared
+        self.ready = {}
+        # Bytes of the prepared images not released yet
+        self.memory = 0
+        self.peakMemory = 0
+        self.stopped = False
+        self.threads = []
+        for i in range(threads):
+            thread = threading.Thread(target=self.run, name='prefetch-%i' % i)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def schedule(self, pagePlans):
+        """
+        Prepare the images of pages going to be rendered, in this order
+        """
+        with self.condition:
+            self.pending.extend(pagePlans)
+            self.condition.notify_all()
+
+    @staticmethod
+    def getKey(pagePlan):
+        return pagePlan.album, pagePlan.page
+
+    def canStart(self):
+        if len(self.pending) == 0 or len(self.started) + len(self.ready) >= self.pages:
+            return False
+        # A page is always started when nothing is prepared, even if it does not fit in the budget alone
+        return self.memory == 0 or self.memory < self.memoryBudget
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.stopped and not self.canStart():
+                    self.condition.wait()
+                if self.stopped:
+                    return
+                pagePlan = self.pending.popleft()
+                self.started.add(ImagePrefetcher.getKey(pagePlan))
+            images = self.prepare(pagePlan)
+            with self.condition:
+                self.started.discard(ImagePrefetcher.getKey(pagePlan))
+                if self.stopped:
+                    self.releaseImages(images)
+                    return
+                self.ready[ImagePrefetcher.getKey(pagePlan)] = images
+                self.condition.notify_all()
+
+    def prepare(self, pagePlan):
+        images = pagePlan.getImages()
+        profiler.setPage(pagePlan.getOutputPath())
+        try:
+            with profiler.phase('prefetch'):
+                self.layouts.getLayout(pagePlan.layoutName).prepare(images)
+        except Exception as e:
+            # Rendered without prefetch, reporting the error where it would have occurred
+            logger.warning('Unable to prefetch page %i (%s)' % (pagePlan.page, e))
+            for imageAndPath in images:
+                imageAndPath.release()
+            return None
+        finally:
+            profiler.setPage(None)
+        for imageAndPath in images:
+            size = imageAndPath.getMemorySize()
+            imageAndPath.onRelease = lambda size=size: self.released(size)
+            with self.condition:
+                self.memory += size
+                self.peakMemory = max(self.peakMemory, self.memory)
+        return images
+
+    def released(self, size):
+        with self.condition:
+            self.memory -= size
+            self.condition.notify_all()
+
+    @staticmethod
+    def releaseImages(images):
+        if images is not None:
+            for imageAndPath in images:
+                imageAndPath.release()
+
+    def take(self, pagePlan):
+        """
+        Return the prepared images of a page, waiting for them if they are being prepared.
+        They are accounted for until released.
+        :return: the images, None if the page has to be rendered without prefetch
+        :rtype: list[ImageAndPath]
+        """
+        key = ImagePrefetcher.getKey(pagePlan)
+        with self.condition:
+            if key not in self.started and key not in self.ready:
+                # Not started yet: preparing it now would not be faster than rendering it
+                if pagePlan in self.pending:
+                    self.pending.remove(pagePlan)
+                profiler.count('prefetchMisses')
+                return None
+            if key in self.ready:
+                profiler.count('prefetchHits')
+            else:
+                profiler.count('prefetchWaits')
+            while key not in self.ready:
+                self.condition.wait()
+            images = self.ready.pop(key)
+            self.condition.notify_all()
+        return images
+
+    def close(self):
+        """
+        Stop the threads and release the images prepared for pages that were not rendered
+        """
+        with self.condition:
+            self.stopped = True
+            self.pending.clear()
+            self.condition.notify_all()
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        for images in self.ready.values():
+            ImagePrefetcher.releaseImages(images)
+        self.ready = {}
+        logger.info('Prefetched images used %.1fMB at most' % (self.peakMemory / 1024. / 1024.))
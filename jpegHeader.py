@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2012 Sebastien Baguet. All rights reserved. Licensed under the new BSD license.
+#
+"""
+Read what albumMaker needs from a JPEG file (dimensions, EXIF orientation and
+caption) by walking its markers, without decoding any pixel.
+"""
+
+import re
+import struct
+
+SOI = 0xD8
+SOS = 0xDA
+EOI = 0xD9
+APP1 = 0xE1
+APP13 = 0xED
+# Start of frame markers, DHT (C4), JPG (C8) and DAC (CC) excepted
+SOF_MARKERS = set(range(0xC0, 0xD0)) - set([0xC4, 0xC8, 0xCC])
+# Markers without a length field
+STANDALONE_MARKERS = set(range(0xD0, 0xD8)) | set([0x01, SOI])
+
+EXIF_ORIENTATION_TAG = 0x0112
+
+XMP_PREFIX = 'http://ns.adobe.com/xap/1.0/\x00'
+# Photoshop image resource holding the IPTC records
+IPTC_RESOURCE = 0x0404
+IPTC_CAPTION = (2, 120)
+IPTC_CODED_CHARACTER_SET = (1, 90)
+IPTC_UTF8 = '\x1b%G'
+# dc:description element, its content being None when it is self-closing
+XMP_DESCRIPTION_ELEMENT_PATTERN = re.compile(r'<dc:description\b[^>]*?(?:/>|>(.*?)</dc:description>)', re.DOTALL)
+XMP_ALTERNATIVE_PATTERN = re.compile(r'<rdf:li\b[^>]*>(.*?)</rdf:li>', re.DOTALL)
+# dc:description attribute of an rdf:Description element
+XMP_DESCRIPTION_ATTRIBUTE_PATTERN = re.compile(r'\sdc:description\s*=\s*(?:"([^"]*)"|\'([^\']*)\')')
+# Entities escaped in XMP text, replaced here rather than by xml.sax.saxutils, whose import costs more than reading
+# the headers of a whole album
+XML_ENTITIES = {'&lt;': '<', '&gt;': '>', '&quot;': '"', '&apos;': "'", '&amp;': '&'}
+XML_ENTITY_PATTERN = re.compile(r'&(?:lt|gt|quot|apos|amp);')
+
+
+class JpegHeaderError(Exception):
+    pass
+
+
+class JpegHeader:
+    def __init__(self, width, height, orientation, caption=None):
+        self.width = width
+        self.height = height
+        # EXIF orientation, None if there is none
+        self.orientation = orientation
+        # IPTC caption, or XMP description if there is no IPTC caption, None if there is none
+        self.caption = caption
+
+
+def readExifOrientation(exif):
+    """
+    Return the Orientation tag of IFD0 of a TIFF/EXIF block, None if missing
+    :param exif: the APP1 payload without the 'Exif\\0\\0' prefix
+    :type exif: str
+    """
+    if len(exif) < 8:
+        return None
+    if exif[0:2] == 'II':
+        endian = '<'
+    elif exif[0:2] == 'MM':
+        endian = '>'
+    else:
+        return None
+    ifdOffset = struct.unpack(endian + 'I', exif[4:8])[0]
+    if ifdOffset + 2 > len(exif):
+        return None
+    entries = struct.unpack(endian + 'H', exif[ifdOffset:ifdOffset + 2])[0]
+    for i in range(entries):
+        entry = ifdOffset + 2 + i * 12
+        if entry + 12 > len(exif):
+            return None
+        (tag, fieldType) = struct.unpack(endian + 'HH', exif[entry:entry + 4])
+        if tag == EXIF_ORIENTATION_TAG:
+            if fieldType == 3:
+                return struct.unpack(endian + 'H', exif[entry + 8:entry + 10])[0]
+            return struct.unpack(endian + 'I', exif[entry + 8:entry + 12])[0]
+    return None
+
+
+def readIptcRecords(photoshop):
+    """
+    Return the IPTC datasets of a Photoshop APP13 block, the first value of each one only
+    :param photoshop: the APP13 payload without the 'Photoshop 3.0\\0' prefix
+    :type photoshop: str
+    :return: (record, dataset) -> value
+    :rtype: dict
+    """
+    records = {}
+    position = 0
+    while position + 12 <= len(photoshop) and photoshop[position:position + 4] == '8BIM':
+        resource = struct.unpack('>H', photoshop[position + 4:position + 6])[0]
+        # Pascal string name, padded to an even length
+        nameLength = ord(photoshop[position + 6])
+        position += 6 + nameLength + 1 + (nameLength + 1) % 2
+        if position + 4 > len(photoshop):
+            break
+        size = struct.unpack('>I', photoshop[position:position + 4])[0]
+        data = photoshop[position + 4:position + 4 + size]
+        position += 4 + size + size % 2
+        if resource != IPTC_RESOURCE:
+            continue
+        offset = 0
+        while offset + 5 <= len(data) and data[offset] == '\x1c':
+            (record, dataset, length) = struct.unpack('>BBH', data[offset + 1:offset + 5])
+            offset += 5
+            if length & 0x8000:
+                # Extended dataset: the length is stored in the next (length & 0x7fff) bytes
+                lengthSize = length & 0x7fff
+                length = 0
+                for byte in data[offset:offset + lengthSize]:
+                    length = (length << 8) + ord(byte)
+                offset += lengthSize
+            records.setdefault((record, dataset), data[offset:offset + length])
+            offset += length
+    return records
+
+
+def decodeIptcText(value, utf8):
+    """
+    :param utf8: whether the IPTC records declare the UTF-8 character set, otherwise UTF-8 is tried first
+    and ISO-8859-15 is the fallback
+    :rtype: unicode
+    """
+    if utf8:
+        return value.decode('utf_8', 'replace')
+    try:
+        return value.decode('utf_8')
+    except UnicodeDecodeError:
+        return value.decode('iso_8859_15')
+
+
+def readIptcCaption(photoshop):
+    """
+    :return: the Caption/Abstract (2:120) of a Photoshop APP13 block, None if missing
+    :rtype: unicode
+    """
+    records = readIptcRecords(photoshop)
+    if IPTC_CAPTION not in records:
+        return None
+    return decodeIptcText(records[IPTC_CAPTION], records.get(IPTC_CODED_CHARACTER_SET) == IPTC_UTF8)
+
+
+def readXmpDescription(xmp):
+    """
+    :return: the dc:description of an XMP packet, its first alternative if there are several, None if missing
+    :rtype: unicode
+    """
+    description = None
+    match = XMP_DESCRIPTION_ELEMENT_PATTERN.search(xmp)
+    if match is not None and match.group(1) is not None:
+        alternative = XMP_ALTERNATIVE_PATTERN.search(match.group(1))
+        if alternative is not None:
+            description = alternative.group(1)
+        elif '<' not in match.group(1) and match.group(1).strip() != '':
+            # Simple value instead of a language alternative
+            description = match.group(1).strip()
+    if description is None:
+        match = XMP_DESCRIPTION_ATTRIBUTE_PATTERN.search(xmp)
+        if match is None:
+            return None
+        # Double or single quoted
+        description = match.group(1)
+        if description is None:
+            description = match.group(2)
+    return unescapeXml(description).decode('utf_8', 'replace')
+
+
+def unescapeXml(text):
+    return XML_ENTITY_PATTERN.sub(lambda match: XML_ENTITIES[match.group(0)], text)
+
+
+def iterSegments(f):
+    """
+    Yield (marker, payload) for every segment before the image data
+    """
+    if f.read(2) != '\xff\xd8':
+        raise JpegHeaderError('Not a JPEG file')
+    while True:
+        byte = f.read(1)
+        if byte == '':
+            return
+        if byte != '\xff':
+            raise JpegHeaderError('Corrupted JPEG marker')
+        while byte == '\xff':
+            # Markers may be preceded by any number of fill bytes
+            byte = f.read(1)
+        if byte == '':
+            return
+        marker = ord(byte)
+        if marker in STANDALONE_MARKERS:
+            continue
+        if marker == SOS or marker == EOI:
+            return
+        lengthBytes = f.read(2)
+        if len(lengthBytes) != 2:
+            return
+        length = struct.unpack('>H', lengthBytes)[0]
+        payload = f.read(length - 2)
+        if len(payload) != length - 2:
+            raise JpegHeaderError('Truncated JPEG segment')
+        yield marker, payload
+
+
+def readHeader(path):
+    """
+    Read the dimensions, EXIF orientation and caption of a JPEG file
+    :rtype: JpegHeader
+    """
+    width = None
+    height = None
+    orientation = None
+    iptcCaption = None
+    xmpDescription = None
+    f = open(path, 'rb')
+    try:
+        for (marker, payload) in iterSegments(f):
+            if marker == APP1 and payload.startswith('Exif\x00\x00') and orientation is None:
+                orientation = readExifOrientation(payload[6:])
+            elif marker == APP1 and payload.startswith(XMP_PREFIX) and xmpDescription is None:
+                xmpDescription = readXmpDescription(payload[len(XMP_PREFIX):])
+            elif marker == APP13 and payload.startswith('Photoshop 3.0\x00') and iptcCaption is None:
+                iptcCaption = readIptcCaption(payload[14:])
+            elif marker in SOF_MARKERS:
+                if len(payload) < 5:
+                    raise JpegHeaderError('Truncated frame header in %s' % path)
+                (height, width) = struct.unpack('>HH', payload[1:5])
+                # The frame header always comes after the APPn segments
+                break
+    finally:
+        f.close()
+    if width is None:
+        raise JpegHeaderError('No frame header found in %s' % path)
+    if iptcCaption is not None:
+        return JpegHeader(width, height, orientation, iptcCaption)
+    return JpegHeader(width, height, orientation, xmpDescription)
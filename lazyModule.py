@@ -0,0 +1,24 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2012 Sebastien Baguet. All rights reserved. Licensed under the new BSD license.
+#
+"""
+Modules imported on their first use rather than at startup, so that the invocations that render nothing
+(planning, --help) do not pay the import of PIL and of the other heavy dependencies.
+
+    Image = LazyModule('PIL.Image')
+    Image.new(...)  # PIL.Image is imported here
+"""
+
+import importlib
+
+
+class LazyModule:
+    def __init__(self, name):
+        self.moduleName = name
+
+    def __getattr__(self, attribute):
+        module = importlib.import_module(self.moduleName)
+        # The next accesses are plain attribute lookups
+        self.__dict__.update(module.__dict__)
+        return getattr(module, attribute)
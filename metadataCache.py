@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2012 Sebastien Baguet. All rights reserved. Licensed under the new BSD license.
+#
+"""
+Persistent cache of the metadata albumMaker extracts from its input files
+(dimensions, EXIF orientation, caption, text length), stored in a SQLite
+database and keyed on (path, size, mtime) so that modified files are read again.
+"""
+
+import json
+import logging
+import os
+
+from lazyModule import LazyModule
+
+# Not needed with --no-cache
+sqlite3 = LazyModule('sqlite3')
+
+logger = logging.getLogger('albumMaker')
+
+
+class MetadataCache:
+    def __init__(self, cachePath):
+        self.cachePath = cachePath
+        # path -> (size, mtime, fields)
+        self.entries = {}
+        # paths whose entry has been checked against the file during this run
+        self.checked = set()
+        self.dirty = set()
+        self.hits = 0
+        self.misses = 0
+        self.load()
+
+    def connect(self):
+        connection = sqlite3.connect(self.cachePath, timeout=30)
+        # Paths are byte strings, whatever the encoding of the file system
+        connection.text_factory = str
+        connection.execute('CREATE TABLE IF NOT EXISTS metadata '
+                           '(path TEXT PRIMARY KEY, size INTEGER, mtime REAL, data TEXT)')
+        return connection
+
+    def load(self):
+        try:
+            connection = self.connect()
+            try:
+                for (path, size, mtime, data) in connection.execute('SELECT path, size, mtime, data FROM metadata'):
+                    self.entries[path] = (size, mtime, json.loads(data))
+            finally:
+                connection.close()
+        except sqlite3.Error as e:
+            logger.warning('Unable to read metadata cache %s (%s), starting from scratch' % (self.cachePath, e))
+            self.entries = {}
+        logger.info('%i entries loaded from metadata cache %s' % (len(self.entries), self.cachePath))
+
+    @staticmethod
+    def getFingerprint(path):
+        stat = os.stat(path)
+        return stat.st_size, stat.st_mtime
+
+    def getFields(self, path):
+        """
+        Return the cached fields of a file, dropping them if the file has changed since they were stored
+        :rtype: dict
+        """
+        if path not in self.checked:
+            self.checked.add(path)
+            entry = self.entries.get(path)
+            if entry is not None and (entry[0], entry[1]) != MetadataCache.getFingerprint(path):
+                logger.debug('%s has changed, metadata invalidated' % path)
+                entry = None
+            if entry is None:
+                (size, mtime) = MetadataCache.getFingerprint(path)
+                self.entries[path] = (size, mtime, {})
+        return self.entries[path][2]
+
+    def get(self, path, field, compute):
+        """
+        Return a field of a file, computing and storing it on a miss
+        :param compute: function without argument returning the value of the field
+        """
+        fields = self.getFields(path)
+        if field in fields:
+            self.hits += 1
+            return fields[field]
+        self.misses += 1
+        value = compute()
+        fields[field] = value
+        self.dirty.add(path)
+        return value
+
+    def save(self):
+        if len(self.dirty) == 0:
+            return
+        try:
+            connection = self.connect()
+            try:
+                connection.executemany('INSERT OR REPLACE INTO metadata (path, size, mtime, data) VALUES (?, ?, ?, ?)',
+                                       [(path, self.entries[path][0], self.entries[path][1],
+                                         json.dumps(self.entries[path][2])) for path in self.dirty])
+                connection.commit()
+            finally:
+                connection.close()
+            logger.info('%i entries saved to metadata cache %s' % (len(self.dirty), self.cachePath))
+            self.dirty = set()
+        except sqlite3.Error as e:
+            logger.warning('Unable to write metadata cache %s (%s)' % (self.cachePath, e))
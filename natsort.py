@@ -1,4 +1,8 @@
 
+import re
+
+_digits_pattern = re.compile(r'(\d+|\D+)')
+
 def try_int(s):
     "Convert to integer if possible."
     try: return int(s)
@@ -6,8 +10,7 @@ def try_int(s):
 
 def natsort_key(s):
     "Used internally to get a tuple by which s is sorted."
-    import re
-    return map(try_int, re.findall(r'(\d+|\D+)', s))
+    return map(try_int, _digits_pattern.findall(s))
 
 def natcmp(a, b):
     "Natural string comparison, case sensitive."
@@ -17,9 +20,19 @@ def natcasecmp(a, b):
     "Natural string comparison, ignores case."
     return natcmp(a.lower(), b.lower())
 
+def natcase_key(s):
+    "Key of the natural string comparison ignoring case."
+    return natsort_key(s.lower())
+
 def natsort(seq, cmp=natcmp):
     "In-place natural string sort."
-    seq.sort(cmp)
+    # The keys are computed once per item, instead of twice per comparison
+    if cmp is natcmp:
+        seq.sort(key=natsort_key)
+    elif cmp is natcasecmp:
+        seq.sort(key=natcase_key)
+    else:
+        seq.sort(cmp)
     
 def natsorted(seq, cmp=natcmp):
     "Returns a copy of seq, sorted by natural string sort."
@@ -27,4 +40,3 @@ def natsorted(seq, cmp=natcmp):
     temp = copy.copy(seq)
     natsort(temp, cmp)
     return temp
-
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2012 Sebastien Baguet. All rights reserved. Licensed under the new BSD license.
+#
+"""
+Page canvas stored in a memory-mapped file, for output resolutions whose pages
+do not fit in memory, enabled by 'canvas = mapped' in the [output] section.
+
+The pixels are RGBX rows of a file next to the output page. Pasting and drawing
+are done strip by strip: only stripHeight rows are copied in memory at once, and
+the rows written back are flushed by the kernel as needed. The encoder reads the
+file through the mapping, so the resident memory of a page does not depend on its
+resolution.
+"""
+
+import mmap
+import os
+
+from lazyModule import LazyModule
+
+Image = LazyModule('PIL.Image')
+ImageDraw = LazyModule('PIL.ImageDraw')
+
+MODE = 'RGBX'
+
+
+def imageFromBytes(mode, size, data):
+    # fromstring was renamed frombytes by Pillow
+    if hasattr(Image, 'frombytes'):
+        return Image.frombytes(mode, size, data)
+    return Image.fromstring(mode, size, data)
+
+
+def imageToBytes(image):
+    if hasattr(image, 'tobytes'):
+        return image.tobytes()
+    return image.tostring()
+
+
+class MappedCanvas:
+    def __init__(self, path, size, color, stripHeight=512):
+        """
+        :param path: file holding the pixels, removed once the canvas is saved or closed
+        :param color: background color, as an RGB tuple
+        """
+        self.path = path
+        self.size = size
+        self.stripHeight = stripHeight
+        self.rowSize = size[0] * len(MODE)
+        self.file = open(path, 'w+b')
+        try:
+            row = ''.join(chr(value) for value in color) + '\xff'
+            strip = row * size[0] * stripHeight
+            for top in range(0, size[1], stripHeight):
+                self.file.write(strip[:self.rowSize * (min(size[1], top + stripHeight) - top)])
+            self.file.flush()
+            self.map = mmap.mmap(self.file.fileno(), self.rowSize * size[1])
+        except:
+            # The disk may be full
+            self.file.close()
+            os.remove(path)
+            raise
+
+    def readStrip(self, top, bottom):
+        return imageFromBytes(MODE, (self.size[0], bottom - top),
+                              self.map[top * self.rowSize:bottom * self.rowSize])
+
+    def writeStrip(self, top, strip):
+        self.map[top * self.rowSize:(top + strip.size[1]) * self.rowSize] = imageToBytes(strip)
+
+    def iterStrips(self, top, bottom):
+        """
+        Yield (top, bottom) of the strips covering the rows top to bottom
+        """
+        top = max(0, top)
+        bottom = min(self.size[1], bottom)
+        while top < bottom:
+            yield top, min(bottom, top + self.stripHeight)
+            top += self.stripHeight
+
+    def paste(self, image, box, mask=None):
+        """
+        Same as Image.paste, for an image or a color pasted at a position or in a box
+        """
+        if len(box) == 4:
+            (top, bottom) = (box[1], box[3])
+        elif hasattr(image, 'size'):
+            (top, bottom) = (box[1], box[1] + image.size[1])
+        else:
+            (top, bottom) = (box[1], box[1] + mask.size[1])
+        for (stripTop, stripBottom) in self.iterStrips(top, bottom):
+            strip = self.readStrip(stripTop, stripBottom)
+            if len(box) == 4:
+                stripBox = (box[0], box[1] - stripTop, box[2], box[3] - stripTop)
+            else:
+                stripBox = (box[0], box[1] - stripTop)
+            strip.paste(image, stripBox, mask)
+            self.writeStrip(stripTop, strip)
+
+    def drawRegion(self, top, bottom, drawFunction):
+        """
+        Call drawFunction(draw, dy) on the rows top to bottom, dy being the offset to add to vertical coordinates
+        """
+        top = max(0, top)
+        bottom = min(self.size[1], bottom)
+        if top >= bottom:
+            return
+        strip = self.readStrip(top, bottom)
+        drawFunction(ImageDraw.Draw(strip), -top)
+        self.writeStrip(top, strip)
+
+    def save(self, path, format, **options):
+        """
+        Encode the canvas from its file, and close it
+        """
+        try:
+            image = Image.frombuffer(MODE, self.size, self.map, 'raw', MODE, 0, 1)
+            if format != 'JPEG':
+                # Only the JPEG encoder reads RGBX pixels
+                image = image.convert('RGB')
+            image.save(path, format, **options)
+        finally:
+            self.close()
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+            self.file.close()
+            os.remove(self.path)
+
+
+def drawOnPage(pageImage, top, bottom, drawFunction):
+    """
+    Call drawFunction(draw, dy) to draw on the rows top to bottom of a page image or canvas, dy being the offset
+    to add to vertical coordinates
+    """
+    if isinstance(pageImage, MappedCanvas):
+        pageImage.drawRegion(top, bottom, drawFunction)
+    else:
+        drawFunction(ImageDraw.Draw(pageImage), 0)
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2012 Sebastien Baguet. All rights reserved. Licensed under the new BSD license.
+#
+"""
+Manifest of the pages written in an output directory, used to rebuild only
+the pages whose inputs changed since the previous run.
+
+Each page is described by a signature (a hash of everything its rendering
+depends on). A page whose signature is unchanged is kept, a page whose
+signature was rendered under another page number (because a previous
+chapter grew or shrank) is moved, and only the others have to be rendered.
+"""
+
+import hashlib
+import json
+import logging
+import os
+
+from lazyModule import LazyModule
+
+# Only needed to copy pages
+shutil = LazyModule('shutil')
+
+logger = logging.getLogger('albumMaker')
+
+# Bump to invalidate every manifest when the rendering itself changes
+MANIFEST_VERSION = 1
+
+
+def getAttributes(value):
+    """
+    :return: the attributes of an object, held in its __dict__ or its __slots__
+    :rtype: dict
+    """
+    if hasattr(value, '__slots__'):
+        return dict((name, getattr(value, name)) for name in value.__slots__)
+    return vars(value)
+
+
+class PageManifest:
+    def __init__(self, manifestPath):
+        self.manifestPath = manifestPath
+        # page number -> signature
+        self.pages = {}
+        self.load()
+
+    @staticmethod
+    def getSignature(description):
+        """
+        :param description: anything json can serialize, objects being serialized through their attributes
+        :rtype: str
+        """
+        data = json.dumps([MANIFEST_VERSION, description], sort_keys=True, default=getAttributes)
+        return hashlib.sha1(data).hexdigest()
+
+    def load(self):
+        if not os.path.exists(self.manifestPath):
+            return
+        try:
+            f = open(self.manifestPath, 'r')
+            try:
+                pages = json.load(f)
+            finally:
+                f.close()
+            self.pages = dict((int(page), str(signature)) for (page, signature) in pages.items())
+        except (IOError, ValueError) as e:
+            logger.warning('Unable to read page manifest %s (%s), rendering every page' % (self.manifestPath, e))
+            self.pages = {}
+
+    def save(self):
+        temporaryPath = self.manifestPath + '.tmp'
+        f = open(temporaryPath, 'w')
+        try:
+            json.dump(self.pages, f, sort_keys=True)
+        finally:
+            f.close()
+        os.rename(temporaryPath, self.manifestPath)
+
+    def update(self, signatures, getOutputPath):
+        """
+        Keep and move the already rendered pages matching the new signatures, delete the stale ones
+        and forget the pages that have to be rendered, until setRendered is called for them.
+        :param signatures: page number -> signature of every page of the new build
+        :type signatures: dict
+        :param getOutputPath: function returning the output file of a page number
+        :return: the page numbers that have to be rendered
+        :rtype: set
+        """
+        old = dict((page, signature) for (page, signature) in self.pages.items()
+                   if os.path.exists(getOutputPath(page)))
+        kept = set(page for page in signatures if old.get(page) == signatures[page])
+
+        # Rendered pages of the previous build, by signature
+        sources = {}
+        for page in sorted(old):
+            sources.setdefault(old[page], page)
+
+        moved = {}
+        for page in sorted(signatures):
+            if page not in kept and signatures[page] in sources:
+                moved[page] = sources[signatures[page]]
+
+        # Move the sources out of the way first: they may be the destination of another move
+        staged = {}
+        for source in set(moved.values()):
+            if source not in kept:
+                staged[source] = getOutputPath(source) + '.old'
+                os.rename(getOutputPath(source), staged[source])
+
+        placed = {}
+        for page in sorted(moved):
+            source = moved[page]
+            if source in placed:
+                # Further copies of a staged page are made from its new location
+                shutil.copyfile(placed[source], getOutputPath(page))
+            elif source in staged:
+                os.rename(staged[source], getOutputPath(page))
+                placed[source] = getOutputPath(page)
+            else:
+                shutil.copyfile(getOutputPath(source), getOutputPath(page))
+            logger.info('Page %i reused as page %i' % (source, page))
+
+        for page in old:
+            if page not in signatures and page not in staged and os.path.exists(getOutputPath(page)):
+                os.remove(getOutputPath(page))
+                logger.info('Stale page %i removed' % page)
+
+        toRender = set(signatures) - kept - set(moved)
+        self.pages = dict((page, signatures[page]) for page in signatures if page not in toRender)
+        self.save()
+        logger.info('%i pages unchanged, %i moved, %i to render' % (len(kept), len(moved), len(toRender)))
+        return toRender
+
+    def setRendered(self, signatures):
+        self.pages.update(signatures)
+        self.save()
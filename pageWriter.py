@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2012 Sebastien Baguet. All rights reserved. Licensed under the new BSD license.
+#
+"""
+Encoding and writing of the rendered pages, following the [output] section of the configuration.
+
+PageWriter encodes pages in a pool of threads (PIL releases the GIL while encoding), so that composing
+a page overlaps encoding the previous ones. At most queueSize composed pages wait for an encoder,
+submitting more blocks until one is written, which bounds the memory used by waiting pages.
+"""
+
+import logging
+import os
+import Queue
+import threading
+
+from profiling import profiler
+
+logger = logging.getLogger('albumMaker')
+
+# File extension of the supported output formats
+EXTENSIONS = {'JPEG': 'jpg', 'PNG': 'png', 'TIFF': 'tif'}
+
+
+class OutputOptions:
+    """
+    How pages are encoded
+    """
+    def __init__(self, format='JPEG', quality=99, subsampling=None, progressive=False):
+        self.format = format
+        self.quality = quality
+        # None keeps the default of the encoder, otherwise 0 (4:4:4), 1 (4:2:2) or 2 (4:2:0)
+        self.subsampling = subsampling
+        self.progressive = progressive
+
+    def getExtension(self):
+        return EXTENSIONS[self.format]
+
+    def getSaveOptions(self):
+        options = {}
+        if self.format == 'JPEG':
+            options['quality'] = self.quality
+            if self.subsampling is not None:
+                options['subsampling'] = self.subsampling
+            if self.progressive:
+                options['progressive'] = True
+        return options
+
+
+def saveImage(image, path, outputOptions):
+    """
+    Encode an image in a temporary file renamed once complete, so that path never holds a partial page.
+    The time spent is accounted to the page of path, see Profiler.setPage.
+    """
+    temporaryPath = '%s.tmp-%i-%i' % (path, os.getpid(), threading.current_thread().ident)
+    try:
+        with profiler.phase('save', path):
+            image.save(temporaryPath, outputOptions.format, **outputOptions.getSaveOptions())
+        os.rename(temporaryPath, path)
+    except:
+        if os.path.exists(temporaryPath):
+            os.remove(temporaryPath)
+        raise
+
+
+class PageWriter:
+    def __init__(self, outputOptions, encoders=2, queueSize=2, onError=None, onWritten=None):
+        """
+        :param encoders: number of encoder threads, 0 to encode pages synchronously
+        :param queueSize: number of pages waiting for an encoder at most
+        :param onError: function called with the path and the exception of every image that could not be
+        written, by default the first error is raised by the next write or by close
+        :param onWritten: function called with the path of every image once written, from the encoder threads
+        """
+        self.outputOptions = outputOptions
+        self.onError = onError
+        self.onWritten = onWritten
+        self.queue = Queue.Queue(max(1, queueSize))
+        self.errors = []
+        self.threads = []
+        for i in range(encoders):
+            thread = threading.Thread(target=self.run, name='encoder-%i' % i)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def write(self, image, path):
+        """
+        Encode and write an image, asynchronously if there are encoder threads.
+        Blocks while queueSize images are already waiting for an encoder.
+        """
+        self.checkErrors()
+        if len(self.threads) == 0:
+            saveImage(image, path, self.outputOptions)
+            if self.onWritten is not None:
+                self.onWritten(path)
+        else:
+            self.queue.put((image, path))
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                (image, path) = item
+                try:
+                    saveImage(image, path, self.outputOptions)
+                except Exception as e:
+                    logger.error('Unable to write %s: %s' % (path, e))
+                    if self.onError is not None:
+                        self.onError(path, e)
+                    else:
+                        self.errors.append(e)
+                    continue
+                logger.debug('%s written' % path)
+                if self.onWritten is not None:
+                    self.onWritten(path)
+            finally:
+                self.queue.task_done()
+
+    def checkErrors(self):
+        if len(self.errors) > 0:
+            raise self.errors[0]
+
+    def close(self):
+        """
+        Wait for every page to be written and stop the encoder threads
+        """
+        for thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        self.checkErrors()
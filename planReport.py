@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2012 Sebastien Baguet. All rights reserved. Licensed under the new BSD license.
+#
+"""
+Page plan written by --plan, so that the ordering of the input files and the layouts can be reviewed without
+rendering anything. Every row describes one page: its album, number, chapter, layout and images, and its
+estimated cost in megapixels decoded, resized and composed, computed from the headers of the images only.
+
+The plan is written as CSV if the file name ends with .csv, as a JSON list of rows otherwise.
+"""
+
+import json
+import logging
+
+from lazyModule import LazyModule
+
+csv = LazyModule('csv')
+
+logger = logging.getLogger('albumMaker')
+
+COLUMNS = ['album', 'page', 'chapter', 'chapterName', 'layout', 'images', 'decodedMegapixels',
+           'resizedMegapixels', 'estimatedCost']
+
+# Separator of the images of a page in the CSV file
+IMAGE_SEPARATOR = '|'
+
+
+def encodeValue(value):
+    if isinstance(value, unicode):
+        return value.encode('utf_8')
+    return value
+
+
+def writePlanReport(path, rows):
+    """
+    :param rows: one dict per page, with the COLUMNS keys, text values being unicode
+    :type rows: list[dict]
+    """
+    f = open(path, 'wb')
+    try:
+        if path.lower().endswith('.csv'):
+            writer = csv.writer(f)
+            writer.writerow(COLUMNS)
+            for row in rows:
+                writer.writerow([encodeValue(IMAGE_SEPARATOR.join(row[column])) if column == 'images'
+                                 else encodeValue(row[column]) for column in COLUMNS])
+        else:
+            # One row per line, without indent so that the C encoder is used
+            f.write('[\n' + ',\n'.join(json.dumps(row, sort_keys=True) for row in rows) + '\n]\n')
+    finally:
+        f.close()
+    logger.info('Plan of %i pages written to %s' % (len(rows), path))
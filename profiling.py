@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2012 Sebastien Baguet. All rights reserved. Licensed under the new BSD license.
+#
+"""
+Per-phase and per-page timing of a run, enabled by --timings and --profile.
+
+    with profiler.phase('resize'):
+        image = image.resize(size)
+    profiler.count('imagesDecoded')
+
+Phases may be nested, the time of a phase includes the time of the phases it
+contains. Memory is the growth of the peak resident size during the phase.
+When profiling is disabled, phase() returns a shared no-op object.
+"""
+
+import json
+import os
+import resource
+import threading
+import time
+
+from lazyModule import LazyModule
+
+# Only needed with --profile
+cProfile = LazyModule('cProfile')
+
+
+class NoPhase:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exceptionType, exception, traceback):
+        return False
+
+NO_PHASE = NoPhase()
+
+
+def getPeakMemoryMB():
+    # kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+def getCpuTime():
+    times = os.times()
+    return times[0] + times[1]
+
+
+class Phase:
+    def __init__(self, profiler, name, page):
+        self.profiler = profiler
+        self.name = name
+        self.page = page
+        self.cProfile = None
+
+    def __enter__(self):
+        self.wall = time.time()
+        self.cpu = getCpuTime()
+        self.memory = getPeakMemoryMB()
+        if self.profiler.cProfileEnabled and self.profiler.activeCProfile is None and \
+                isinstance(threading.current_thread(), threading._MainThread):
+            # Only one cProfile can be active at once, nested phases are accounted to the outer one,
+            # and phases of other threads are not profiled
+            self.cProfile = self.profiler.cProfiles.setdefault(self.name, cProfile.Profile())
+            self.profiler.activeCProfile = self.cProfile
+            self.cProfile.enable()
+        return self
+
+    def __exit__(self, exceptionType, exception, traceback):
+        if self.cProfile is not None:
+            self.cProfile.disable()
+            self.profiler.activeCProfile = None
+        self.profiler.add(self.name, time.time() - self.wall, getCpuTime() - self.cpu,
+                          getPeakMemoryMB() - self.memory, self.page)
+        return False
+
+
+class Profiler:
+    def __init__(self):
+        self.enabled = False
+        self.cProfileEnabled = False
+        self.activeCProfile = None
+        self.cProfiles = {}
+        # The current page of every thread
+        self.local = threading.local()
+        # Phases may end in encoder threads
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        # phase -> {'calls', 'wall', 'cpu', 'memoryMB'}
+        self.phases = {}
+        # page output path -> phase -> same as phases
+        self.pages = {}
+        self.counters = {}
+
+    def enable(self, cProfileEnabled=False):
+        self.enabled = True
+        self.cProfileEnabled = cProfileEnabled
+
+    def phase(self, name, page=None):
+        """
+        :param page: output path of the page to account the phase to, the current page by default
+        """
+        if not self.enabled:
+            return NO_PHASE
+        if page is None:
+            page = getattr(self.local, 'page', None)
+        return Phase(self, name, page)
+
+    def setPage(self, page):
+        """
+        Account the next phases of the current thread to a page, None for phases not related to a page
+        :param page: output path of the page, unique across the albums of a batch unlike its number
+        """
+        self.local.page = page
+
+    def count(self, name, value=1):
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    @staticmethod
+    def addTiming(timings, name, calls, wall, cpu, memory):
+        timing = timings.setdefault(name, {'calls': 0, 'wall': 0., 'cpu': 0., 'memoryMB': 0.})
+        timing['calls'] += calls
+        timing['wall'] += wall
+        timing['cpu'] += cpu
+        timing['memoryMB'] += memory
+
+    def add(self, name, wall, cpu, memory, page=None):
+        with self.lock:
+            Profiler.addTiming(self.phases, name, 1, wall, cpu, memory)
+            if page is not None:
+                Profiler.addTiming(self.pages.setdefault(page, {}), name, 1, wall, cpu, memory)
+
+    def getReport(self):
+        return {'phases': self.phases, 'pages': self.pages, 'counters': self.counters,
+                'peakMemoryMB': getPeakMemoryMB()}
+
+    def takeReport(self):
+        """
+        Return the report and start a new one, used to send the timings of worker processes to the main one
+        """
+        report = self.getReport()
+        self.reset()
+        return report
+
+    def merge(self, report):
+        for (name, timing) in report['phases'].items():
+            Profiler.addTiming(self.phases, name, timing['calls'], timing['wall'], timing['cpu'], timing['memoryMB'])
+        for (page, phases) in report['pages'].items():
+            for (name, timing) in phases.items():
+                Profiler.addTiming(self.pages.setdefault(page, {}), name, timing['calls'], timing['wall'],
+                                   timing['cpu'], timing['memoryMB'])
+        for (name, value) in report['counters'].items():
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def save(self, path):
+        f = open(path, 'w')
+        try:
+            json.dump(self.getReport(), f, indent=2, sort_keys=True)
+        finally:
+            f.close()
+
+    def dumpCProfiles(self, directory, suffix=''):
+        """
+        Write one cProfile dump per phase, readable with pstats
+        """
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        for (name, profile) in self.cProfiles.items():
+            profile.dump_stats(os.path.join(directory, '%s%s.prof' % (name, suffix)))
+
+    def summary(self):
+        """
+        :return: one line per phase, slowest first
+        :rtype: list[str]
+        """
+        lines = []
+        for (name, timing) in sorted(self.phases.items(), key=lambda item: -item[1]['wall']):
+            lines.append('%-16s %6i calls %9.3fs wall %9.3fs cpu %8.1fMB' % (name, timing['calls'], timing['wall'],
+                                                                           timing['cpu'], timing['memoryMB']))
+        for (name, value) in sorted(self.counters.items()):
+            lines.append('%-16s %6i' % (name, value))
+        return lines
+
+profiler = Profiler()
@@ -0,0 +1,276 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2012 Sebastien Baguet. All rights reserved. Licensed under the new BSD license.
+#
+"""
+Render service keeping albumMaker loaded between albums, so that scripts rendering many albums do not pay its
+startup for every one of them and follow their progress page by page.
+
+    ./renderService.py serve --port 8765 --jobs 4
+    ./renderService.py submit --port 8765 <inputdir> -o <outputdir> --set output.quality=90
+
+Clients connect to the local port and send one JSON line describing a job:
+
+    {"inputdir": "...", "outputdir": "...", "config": {"output.quality": "90"}, "incremental": false}
+
+The service answers with one JSON line per event until the job is done: queued, started, planned, page (for
+every rendered page) and done. Jobs are rendered one at a time in submission order by a pool of worker
+processes forked once when the service starts, before any of its threads: the parsed layouts, loaded fonts and
+the caches of the albums stay warm between jobs in the service and in the workers, and concurrent submissions
+wait in the queue instead of oversubscribing the cores.
+"""
+
+import argparse
+import json
+import logging
+import multiprocessing
+import Queue
+import socket
+import SocketServer
+import sys
+import threading
+
+import albumMaker
+from colorLogging import ColorizingStreamHandler
+from imageMemory import imageMemory
+
+logger = logging.getLogger('albumMaker')
+
+DEFAULT_PORT = 8765
+
+
+class RenderJob:
+    def __init__(self, number, inputdir, outputdir, overrides, incremental):
+        """
+        :param outputdir: output directory, <inputdir>/out if None
+        :param overrides: configuration values by 'section.option', see parseConfig
+        """
+        self.number = number
+        self.inputdir = inputdir
+        self.outputdir = outputdir
+        self.overrides = overrides
+        self.incremental = incremental
+        self.events = Queue.Queue()
+
+    def emit(self, event, **fields):
+        fields['event'] = event
+        fields['job'] = self.number
+        self.events.put(fields)
+
+
+class ServiceAlbum(albumMaker.Album):
+    """
+    Album reporting its progress to the events of its job, and keeping its caches open between jobs
+    """
+    def __init__(self, job, caches):
+        """
+        :param caches: caches of the albums rendered by the service, by input directory
+        :type caches: dict
+        """
+        outputdir = job.outputdir
+        if outputdir is None:
+            outputdir = job.inputdir + '/out'
+        albumMaker.Album.__init__(self, job.inputdir + '/', outputdir + '/')
+        self.job = job
+        self.caches = caches
+
+    def openCaches(self, cacheFile, noCache):
+        if self.inputdir not in self.caches:
+            albumMaker.Album.openCaches(self, cacheFile, noCache)
+            self.caches[self.inputdir] = (self.metadataCache, self.derivedImageCache, self.textImageCache)
+        (self.metadataCache, self.derivedImageCache, self.textImageCache) = self.caches[self.inputdir]
+        if self.metadataCache is not None:
+            # Files may have changed since the previous job
+            self.metadataCache.checked.clear()
+
+    def plan(self, layouts, chapterStream, incremental, renderer=None):
+        albumMaker.Album.plan(self, layouts, chapterStream, incremental, renderer)
+        self.job.emit('planned', pages=len(self.pagePlans) + 1, pagesToRender=len(self.plansToRender),
+                      complete=self.complete)
+
+    def pageRendered(self, pagePlan):
+        albumMaker.Album.pageRendered(self, pagePlan)
+        self.job.emit('page', page=pagePlan.page, pagesLeft=self.pagesLeft)
+
+
+class RenderService:
+    def __init__(self, configFile, jobs):
+        """
+        :param jobs: number of worker processes rendering the pages of a job
+        """
+        self.configFile = configFile
+        self.jobs = jobs
+        self.queue = Queue.Queue()
+        self.lock = threading.Lock()
+        self.submitted = 0
+        self.layouts = None
+        # Values the layouts have been built from, sent to the workers with the pages of every job
+        self.configValues = None
+        # Overrides the layouts have been parsed with
+        self.overrides = None
+        self.caches = {}
+        # Forked before any thread of the service exists, and reused by every job
+        self.pool = None
+        if jobs > 1:
+            self.pool = albumMaker.createRenderPool(jobs)
+        self.thread = threading.Thread(target=self.run, name='render')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, inputdir, outputdir=None, overrides=None, incremental=False):
+        """
+        :rtype: RenderJob
+        """
+        with self.lock:
+            self.submitted += 1
+            job = RenderJob(self.submitted, inputdir, outputdir, overrides or {}, incremental)
+            job.emit('queued', position=self.queue.qsize())
+            self.queue.put(job)
+        return job
+
+    def getLayouts(self, overrides):
+        """
+        Parse the configuration again only if its overrides differ from the previous job's
+        """
+        if self.layouts is None or overrides != self.overrides:
+            self.configValues = albumMaker.readConfigValues(self.configFile, overrides)
+            (pageProperties, self.layouts) = albumMaker.buildConfig(self.configValues)
+            imageMemory.setBudget(pageProperties.memoryBudgetMB)
+            self.overrides = overrides
+        return self.layouts
+
+    def run(self):
+        while True:
+            job = self.queue.get()
+            logger.info('Starting job %i: %s' % (job.number, job.inputdir))
+            job.emit('started')
+            try:
+                layouts = self.getLayouts(job.overrides)
+                album = ServiceAlbum(job, self.caches)
+                success = albumMaker.renderBatch([album], layouts, {'cache': None, 'noCache': False,
+                                                                    'incremental': job.incremental,
+                                                                    'planOnly': False, 'jobs': self.jobs,
+                                                                    'pool': self.pool,
+                                                                    'config': self.configValues})
+            except Exception as e:
+                logger.exception('Job %i failed' % job.number)
+                job.emit('done', success=False, error=str(e))
+                continue
+            job.emit('done', success=success, summary=album.getSummary(), error=album.error,
+                     failures=[{'page': page, 'error': error} for (page, error) in album.failures])
+
+
+class JobHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline())
+            if not isinstance(request, dict) or not isinstance(request.get('inputdir'), basestring):
+                raise ValueError('inputdir is missing')
+        except ValueError as e:
+            self.sendEvent({'event': 'error', 'error': 'Invalid request (%s)' % e})
+            return
+        outputdir = request.get('outputdir')
+        if outputdir is not None:
+            outputdir = str(outputdir)
+        job = self.server.service.submit(str(request['inputdir']), outputdir, request.get('config'),
+                                         bool(request.get('incremental')))
+        while True:
+            event = job.events.get()
+            try:
+                self.sendEvent(event)
+            except socket.error:
+                # The job goes on without its client
+                logger.warning('Client of job %i disconnected' % job.number)
+                return
+            if event['event'] == 'done':
+                return
+
+    def sendEvent(self, event):
+        self.wfile.write(json.dumps(event) + '\n')
+        self.wfile.flush()
+
+
+class JobServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, service):
+        SocketServer.TCPServer.__init__(self, address, JobHandler)
+        self.service = service
+
+
+def submitJob(address, inputdir, outputdir=None, overrides=None, incremental=False):
+    """
+    Submit a job to a render service and yield its events, until the done one
+    :param address: (host, port) of the service
+    :rtype: collections.Iterable[dict]
+    """
+    connection = socket.create_connection(address)
+    try:
+        connection.sendall(json.dumps({'inputdir': inputdir, 'outputdir': outputdir, 'config': overrides,
+                                       'incremental': incremental}) + '\n')
+        events = connection.makefile('rb')
+        for line in events:
+            event = json.loads(line)
+            yield event
+            if event['event'] in ('done', 'error'):
+                break
+    finally:
+        connection.close()
+
+
+def describeEvent(event):
+    if event['event'] == 'queued':
+        return 'Job %i queued after %i jobs' % (event['job'], event['position'])
+    if event['event'] == 'planned':
+        return '%i pages planned, %i to render' % (event['pages'], event['pagesToRender'])
+    if event['event'] == 'page':
+        return 'Page %i rendered, %i left' % (event['page'], event['pagesLeft'])
+    if event['event'] == 'done':
+        return event.get('summary') or event.get('error')
+    if event['event'] == 'error':
+        return event['error']
+    return 'Job %i %s' % (event['job'], event['event'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Render albums in a long-running service')
+    address = argparse.ArgumentParser(add_help=False)
+    address.add_argument('--host', default='127.0.0.1')
+    address.add_argument('--port', type=int, default=DEFAULT_PORT)
+    commands = parser.add_subparsers(dest='command')
+    serve = commands.add_parser('serve', parents=[address], help='run the service')
+    serve.add_argument('--config', default='configuration.cfg')
+    serve.add_argument('-j', '--jobs', dest='jobs', type=int, default=multiprocessing.cpu_count(),
+    help='number of worker processes rendering the pages of a job (default: number of cores)')
+    submit = commands.add_parser('submit', parents=[address], help='render an album with the service and follow its progress')
+    submit.add_argument('inputdir')
+    submit.add_argument('-o', '--out', dest='outputDirectory')
+    submit.add_argument('--set', dest='overrides', action='append', default=[], metavar='SECTION.OPTION=VALUE',
+    help='override a value of the configuration of the service for this job')
+    submit.add_argument('--incremental', dest='incremental', action='store_const', const=True, default=False)
+    args = parser.parse_args()
+
+    logger.addHandler(ColorizingStreamHandler())
+    logger.setLevel(logging.INFO)
+
+    if args.command == 'serve':
+        server = JobServer((args.host, args.port), RenderService(args.config, args.jobs))
+        logger.info('Render service listening on %s:%i with %i jobs' % (args.host, args.port, args.jobs))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        return
+
+    overrides = dict(override.split('=', 1) for override in args.overrides)
+    success = False
+    for event in submitJob((args.host, args.port), args.inputdir, args.outputDirectory, overrides,
+                           args.incremental):
+        logger.info(describeEvent(event))
+        success = event.get('success', False)
+    if not success:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
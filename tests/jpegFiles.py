@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2012 Sebastien Baguet. All rights reserved. Licensed under the new BSD license.
+#
+"""
+JPEG files made of headers only, enough for albumMaker to plan pages without PIL
+"""
+
+import struct
+
+EXIF_ENDIANS = {'II': '<', 'MM': '>'}
+
+
+def getSegment(marker, payload):
+    return struct.pack('>BBH', 0xFF, marker, len(payload) + 2) + payload
+
+
+def getFrame(width, height, marker=0xC0):
+    """
+    :param marker: SOF marker of the frame, baseline by default
+    """
+    return getSegment(marker, struct.pack('>BHHB', 8, height, width, 1) + '\x01\x11\x00')
+
+
+def getExifSegment(orientation, byteOrder='MM', fieldType=3):
+    """
+    :param byteOrder: 'MM' for big-endian, 'II' for little-endian
+    :param fieldType: 3 to store the orientation as a SHORT, 4 as a LONG
+    """
+    endian = EXIF_ENDIANS[byteOrder]
+    if fieldType == 3:
+        value = struct.pack(endian + 'HH', orientation, 0)
+    else:
+        value = struct.pack(endian + 'I', orientation)
+    # Make before Orientation, as tags are sorted in IFD0
+    entries = [struct.pack(endian + 'HHI', 0x010F, 2, 4) + 'Cam\x00',
+               struct.pack(endian + 'HHI', 0x0112, fieldType, 1) + value]
+    tiff = (byteOrder + struct.pack(endian + 'HI', 42, 8) + struct.pack(endian + 'H', len(entries)) +
+            ''.join(entries) + struct.pack(endian + 'I', 0))
+    return getSegment(0xE1, 'Exif\x00\x00' + tiff)
+
+
+def getIptcSegment(caption, utf8=False):
+    """
+    :param utf8: whether to declare the UTF-8 character set in the 1:90 record
+    """
+    datasets = []
+    if utf8:
+        datasets.append((1, 90, '\x1b%G'))
+    datasets.append((2, 120, caption))
+    iptc = ''.join('\x1c' + struct.pack('>BBH', record, dataset, len(value)) + value
+                   for (record, dataset, value) in datasets)
+    # A resolution info resource with an odd size first, skipped with its padding byte
+    resources = [(0x03ED, 'x' * 15), (0x0404, iptc)]
+    photoshop = ''
+    for (resource, data) in resources:
+        photoshop += '8BIM' + struct.pack('>HBBI', resource, 0, 0, len(data)) + data + '\x00' * (len(data) % 2)
+    return getSegment(0xED, 'Photoshop 3.0\x00' + photoshop)
+
+
+def getJpeg(width, height, segments=()):
+    """
+    :param segments: the encoded segments written between SOI and the SOF0 frame, see getSegment
+    :rtype: str
+    """
+    return '\xff\xd8' + ''.join(segments) + getFrame(width, height) + '\xff\xd9'
+
+
+def writeJpeg(path, width, height, segments=()):
+    writeFile(path, getJpeg(width, height, segments))
+
+
+def writeFile(path, content):
+    f = open(path, 'wb')
+    try:
+        f.write(content)
+    finally:
+        f.close()
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2012 Sebastien Baguet. All rights reserved. Licensed under the new BSD license.
+#
+"""
+Headers read by jpegHeader, from JPEG files made of headers only
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import albumMaker
+from jpegFiles import getExifSegment, getFrame, getIptcSegment, getJpeg, getSegment, writeFile, writeJpeg
+from jpegHeader import XMP_PREFIX, JpegHeaderError, readHeader, readXmpDescription
+
+XMP_PACKET = '''<x:xmpmeta xmlns:x="adobe:ns:meta/"><rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">
+<rdf:Description rdf:about="" xmlns:dc="http://purl.org/dc/elements/1.1/"%s>
+%s
+<dc:subject><rdf:Bag><rdf:li>beach</rdf:li></rdf:Bag></dc:subject>
+</rdf:Description></rdf:RDF></x:xmpmeta>'''
+
+
+def getXmp(description='', attributes=''):
+    return XMP_PACKET % (attributes, description)
+
+
+class XmpDescriptionTest(unittest.TestCase):
+    def testFirstAlternative(self):
+        self.assertEqual(readXmpDescription(getXmp(
+            '<dc:description><rdf:Alt><rdf:li xml:lang="x-default">Sunset &amp; sea</rdf:li>'
+            '<rdf:li xml:lang="fr">Coucher</rdf:li></rdf:Alt></dc:description>')), u'Sunset & sea')
+
+    def testUtf8(self):
+        self.assertEqual(readXmpDescription(getXmp(
+            '<dc:description><rdf:Alt><rdf:li>Ch\xc3\xa2teau</rdf:li></rdf:Alt></dc:description>')), u'Ch\xe2teau')
+
+    def testEmptyElementIsNotFollowedIntoOtherProperties(self):
+        self.assertEqual(readXmpDescription(getXmp('<dc:description></dc:description>')), None)
+        self.assertEqual(readXmpDescription(getXmp('<dc:description><rdf:Alt/></dc:description>')), None)
+
+    def testSelfClosingElementIsNotFollowedIntoOtherProperties(self):
+        self.assertEqual(readXmpDescription(getXmp('<dc:description/>')), None)
+
+    def testAttribute(self):
+        self.assertEqual(readXmpDescription(getXmp(attributes=' dc:description="At the &quot;beach&quot;"')),
+                         u'At the "beach"')
+        self.assertEqual(readXmpDescription(getXmp(attributes=" dc:description='Dunes'")), u'Dunes')
+
+    def testMissing(self):
+        self.assertEqual(readXmpDescription(getXmp()), None)
+
+    def testReadHeader(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'photo.jpg')
+            writeJpeg(path, 640, 480, [getSegment(0xE1, XMP_PREFIX + getXmp(
+                '<dc:description><rdf:Alt><rdf:li>Dunes</rdf:li></rdf:Alt></dc:description>'))])
+            self.assertEqual(readHeader(path).caption, u'Dunes')
+        finally:
+            shutil.rmtree(directory)
+
+
+class ReadHeaderTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'photo.jpg')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def read(self, content):
+        writeFile(self.path, content)
+        return readHeader(self.path)
+
+    def getFullJpeg(self):
+        return getJpeg(640, 480, [getExifSegment(6, 'II'), getIptcSegment('Dunes'),
+                                  getSegment(0xE1, XMP_PREFIX + getXmp('<dc:description>Sea</dc:description>'))])
+
+    def testFrameSize(self):
+        header = self.read(getJpeg(640, 480))
+        self.assertEqual((header.width, header.height, header.orientation, header.caption), (640, 480, None, None))
+
+    def testProgressiveFrameAfterHuffmanTable(self):
+        # DHT shares the range of the SOF markers
+        header = self.read('\xff\xd8' + getSegment(0xC4, '\x00' * 17) + getFrame(3000, 4000, 0xC2) + '\xff\xd9')
+        self.assertEqual((header.width, header.height), (3000, 4000))
+
+    def testExifOrientations(self):
+        for byteOrder in ('II', 'MM'):
+            for orientation in range(1, 9):
+                header = self.read(getJpeg(640, 480, [getExifSegment(orientation, byteOrder)]))
+                self.assertEqual((header.width, header.height, header.orientation), (640, 480, orientation))
+
+    def testLongExifOrientation(self):
+        for byteOrder in ('II', 'MM'):
+            self.assertEqual(self.read(getJpeg(640, 480, [getExifSegment(8, byteOrder, 4)])).orientation, 8)
+
+    def testIptcCaption(self):
+        self.assertEqual(self.read(getJpeg(640, 480, [getIptcSegment('Dunes')])).caption, u'Dunes')
+
+    def testIptcCaptionCharacterSets(self):
+        self.assertEqual(self.read(getJpeg(640, 480, [getIptcSegment('Ch\xe2teau')])).caption, u'Ch\xe2teau')
+        self.assertEqual(self.read(getJpeg(640, 480, [getIptcSegment('Ch\xc3\xa2teau')])).caption, u'Ch\xe2teau')
+        self.assertEqual(self.read(getJpeg(640, 480, [getIptcSegment('Ch\xc3\xa2teau', True)])).caption,
+                         u'Ch\xe2teau')
+
+    def testIptcCaptionComesBeforeXmpDescription(self):
+        self.assertEqual(self.read(self.getFullJpeg()).caption, u'Dunes')
+
+    def testTruncatedFiles(self):
+        content = self.getFullJpeg()
+        frameEnd = len(content) - 2
+        for length in range(frameEnd):
+            self.assertRaises(JpegHeaderError, self.read, content[:length])
+        for length in range(frameEnd, len(content) + 1):
+            header = self.read(content[:length])
+            self.assertEqual((header.width, header.height, header.orientation, header.caption),
+                             (640, 480, 6, u'Dunes'))
+
+    def testTruncatedFrameHeader(self):
+        self.assertRaises(JpegHeaderError, self.read, '\xff\xd8' + getSegment(0xC0, '\x08\x01') + '\xff\xd9')
+
+    def testGarbageFiles(self):
+        for content in ('', 'Not a photo', '\xff\xd8Not a photo', '\xff\xd8\xff\xe1\x00'):
+            self.assertRaises(JpegHeaderError, self.read, content)
+
+    def testGarbageSegmentsAreIgnored(self):
+        for segment in (getSegment(0xE1, 'Exif\x00\x00MM\x00\x2a\xff\xff\xff\xff'),
+                        getSegment(0xE1, 'Exif\x00\x00II\x2a\x00\x08\x00\x00\x00\xff\xff'),
+                        getSegment(0xE1, 'Exif\x00\x00XX'),
+                        getSegment(0xED, 'Photoshop 3.0\x008BIM\x04\x04\xff\x00\x00\x00'),
+                        getSegment(0xED, 'Photoshop 3.0\x008BIM\x04\x04\x00\x00\xff\xff\xff\xff\x1c\x02'),
+                        getSegment(0xE1, XMP_PREFIX + '<dc:description><rdf:li>')):
+            header = self.read(getJpeg(640, 480, [segment]))
+            self.assertEqual((header.width, header.height, header.orientation, header.caption), (640, 480, None, None))
+
+    def testCorruptedBytesOnlyRaiseJpegHeaderError(self):
+        content = self.getFullJpeg()
+        for position in range(len(content)):
+            for byte in ('\x00', '\xff'):
+                try:
+                    self.read(content[:position] + byte + content[position + 1:])
+                except JpegHeaderError:
+                    pass
+
+    def testCaptionFallsBackWithoutRaising(self):
+        writeFile(self.path, '\xff\xd8Not a photo')
+        self.assertEqual(albumMaker.ImageAndPath(self.path).readCaption(), '')
+
+
+if __name__ == '__main__':
+    unittest.main()
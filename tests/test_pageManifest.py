@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2012 Sebastien Baguet. All rights reserved. Licensed under the new BSD license.
+#
+"""
+PageManifest.update on a temporary output directory, every page file holding the signature it was rendered with.
+
+    python -m unittest discover
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import albumMaker
+from jpegFiles import writeJpeg
+from pageManifest import PageManifest
+
+CONFIG_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'configuration.cfg')
+
+
+class PageManifestUpdateTest(unittest.TestCase):
+    def setUp(self):
+        self.outputdir = tempfile.mkdtemp()
+        self.manifestPath = os.path.join(self.outputdir, '.albumMaker-manifest.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.outputdir)
+
+    def getOutputPath(self, page):
+        return os.path.join(self.outputdir, 'page-%i.jpg' % page)
+
+    def build(self, signatures):
+        """
+        Update the manifest for the signatures and render the pages it selects, as an incremental run does
+        :return: the rendered pages
+        :rtype: set
+        """
+        manifest = PageManifest(self.manifestPath)
+        toRender = manifest.update(signatures, self.getOutputPath)
+        for page in toRender:
+            f = open(self.getOutputPath(page), 'w')
+            try:
+                f.write(signatures[page])
+            finally:
+                f.close()
+        manifest.setRendered(dict((page, signatures[page]) for page in toRender))
+        return toRender
+
+    def assertOutput(self, signatures):
+        """
+        Check that the output directory holds exactly the pages of the signatures, as a full rebuild would
+        """
+        pages = {}
+        for name in os.listdir(self.outputdir):
+            if name.startswith('.'):
+                continue
+            f = open(os.path.join(self.outputdir, name), 'r')
+            try:
+                pages[name] = f.read()
+            finally:
+                f.close()
+        self.assertEqual(pages, dict(('page-%i.jpg' % page, signature) for (page, signature) in signatures.items()))
+
+    def testFirstBuildRendersEveryPage(self):
+        signatures = {0: 'index', 1: 'a', 2: 'b'}
+        self.assertEqual(self.build(signatures), set([0, 1, 2]))
+        self.assertOutput(signatures)
+
+    def testUnchangedPagesAreKept(self):
+        signatures = {0: 'index', 1: 'a', 2: 'b'}
+        self.build(signatures)
+        self.assertEqual(self.build(signatures), set())
+        self.assertOutput(signatures)
+
+    def testGrowingChapterShiftsTheNextPages(self):
+        self.build({0: 'index', 1: 'a', 2: 'b', 3: 'c'})
+        signatures = {0: 'index', 1: 'a', 2: 'new', 3: 'b', 4: 'c'}
+        self.assertEqual(self.build(signatures), set([2]))
+        self.assertOutput(signatures)
+
+    def testShrinkingChapterShiftsTheNextPagesAndRemovesTheLastOne(self):
+        self.build({0: 'index', 1: 'a', 2: 'b', 3: 'c', 4: 'd'})
+        signatures = {0: 'index', 1: 'a', 2: 'c', 3: 'd'}
+        self.assertEqual(self.build(signatures), set())
+        self.assertOutput(signatures)
+
+    def testDuplicateSignaturesAreCopied(self):
+        self.build({0: 'index', 1: 'a', 2: 'b'})
+        signatures = {0: 'index', 1: 'b', 2: 'b', 3: 'b'}
+        self.assertEqual(self.build(signatures), set())
+        self.assertOutput(signatures)
+
+    def testDuplicateSignaturesOfAKeptPageAreCopied(self):
+        self.build({0: 'index', 1: 'a', 2: 'b'})
+        signatures = {0: 'index', 1: 'a', 2: 'a', 3: 'b'}
+        self.assertEqual(self.build(signatures), set())
+        self.assertOutput(signatures)
+
+    def testSwappedPagesAreSourcesAndDestinations(self):
+        self.build({0: 'index', 1: 'a', 2: 'b', 3: 'c'})
+        signatures = {0: 'index', 1: 'c', 2: 'a', 3: 'b'}
+        self.assertEqual(self.build(signatures), set())
+        self.assertOutput(signatures)
+
+    def testMissingPagesAreRenderedAgain(self):
+        self.build({0: 'index', 1: 'a', 2: 'b'})
+        os.remove(self.getOutputPath(1))
+        signatures = {0: 'index', 1: 'b', 2: 'a'}
+        self.assertEqual(self.build(signatures), set([2]))
+        self.assertOutput(signatures)
+
+    def testPagesLeftUnrenderedAreRenderedByTheNextRun(self):
+        self.build({0: 'index', 1: 'a'})
+        signatures = {0: 'index', 1: 'a', 2: 'b'}
+        manifest = PageManifest(self.manifestPath)
+        self.assertEqual(manifest.update(signatures, self.getOutputPath), set([2]))
+        # The run failed before rendering page 2
+        self.assertEqual(self.build(signatures), set([2]))
+        self.assertOutput(signatures)
+
+
+class BatchIncrementalTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def getAlbumDirectory(self, name):
+        inputdir = os.path.join(self.directory, name)
+        os.makedirs(inputdir)
+        for (number, size) in enumerate([(4000, 3000), (3000, 4000), (4000, 3000)]):
+            writeJpeg(os.path.join(inputdir, '1 - Chapter (%i).jpg' % number), size[0], size[1])
+        return inputdir
+
+    def testFirstRunCreatesTheOutputDirectories(self):
+        (pageProperties, layouts) = albumMaker.parseConfig(CONFIG_FILE)
+        outputDirectory = os.path.join(self.directory, 'out')
+        albums = albumMaker.getBatchAlbums([(self.getAlbumDirectory('a'), None),
+                                            (self.getAlbumDirectory('b'), None)], outputDirectory)
+        self.assertTrue(albumMaker.renderBatch(albums, layouts, {'cache': None, 'noCache': True,
+                                                                 'incremental': True, 'planOnly': True,
+                                                                 'jobs': 1}))
+        for album in albums:
+            self.assertEqual(album.error, None)
+            self.assertTrue(os.path.exists(album.outputdir + '.albumMaker-manifest.json'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2012 Sebastien Baguet. All rights reserved. Licensed under the new BSD license.
+#
+"""
+Pages planned by planLayouts and planChapter, from the signatures of the images only
+"""
+
+import unittest
+
+import albumMaker
+from albumMaker import Layout, LayoutIndex, Size, planChapter, planLayouts
+
+
+def getLayout(name, orientations, cost=None):
+    """
+    :param orientations: orientation of every slot, 'h' or 'v'
+    """
+    layout = Layout(name, albumMaker.pageProperties)
+    if cost is not None:
+        layout.cost = cost
+    for orientation in orientations:
+        layout.addSlot(orientation, Size('0x0'), Size('auto'))
+    return layout
+
+
+def getLayoutNames(pages):
+    return [(index, imageNumber, layout and layout.name) for (index, imageNumber, layout) in pages]
+
+
+class PlannedImage:
+    """
+    What planChapter reads from an ImageAndPath
+    """
+    def __init__(self, name, signature):
+        self.name = name
+        self.signature = signature
+
+    def getSignature(self):
+        return self.signature
+
+    def getName(self):
+        return self.name
+
+    def getPath(self):
+        return '/album/' + self.name
+
+    def getCaption(self):
+        return ''
+
+
+class PlanLayoutsTest(unittest.TestCase):
+    def testEveryImageIsPlacedOnTheFewestPages(self):
+        layouts = LayoutIndex([getLayout('three', 'hhh'), getLayout('mixed', 'hv'), getLayout('two', 'hh')])
+        # Filling the first page with three photos would leave the last one alone, and no layout takes it
+        self.assertEqual(getLayoutNames(planLayouts(layouts, ['h', 'h', 'h', 'v'])),
+                         [(0, 2, 'two'), (2, 2, 'mixed')])
+
+    def testPagesOfMostImagesComeFirst(self):
+        layouts = LayoutIndex([getLayout('one', 'h'), getLayout('two', 'hh'), getLayout('three', 'hhh')])
+        self.assertEqual(getLayoutNames(planLayouts(layouts, ['h'] * 4)), [(0, 3, 'three'), (3, 1, 'one')])
+
+    def testCostsAreMinimized(self):
+        layouts = LayoutIndex([getLayout('one', 'h'), getLayout('two', 'hh', 3.)])
+        self.assertEqual(getLayoutNames(planLayouts(layouts, ['h', 'h'])), [(0, 1, 'one'), (1, 1, 'one')])
+        layouts = LayoutIndex([getLayout('one', 'h'), getLayout('two', 'hh', 1.5)])
+        self.assertEqual(getLayoutNames(planLayouts(layouts, ['h', 'h'])), [(0, 2, 'two')])
+
+    def testCheapestCompatibleLayoutIsChosen(self):
+        layouts = LayoutIndex([getLayout('expensive', 'hh', 2.), getLayout('cheap', 'hh', 0.5)])
+        self.assertEqual(getLayoutNames(planLayouts(layouts, ['h', 'h'])), [(0, 2, 'cheap')])
+
+    def testImagesAreOnlyLeftOutWhenTheyFitNoLayout(self):
+        # Leaving out the photo alone would save a page
+        layouts = LayoutIndex([getLayout('one', 'h', 10.), getLayout('two', 'hh')])
+        self.assertEqual(getLayoutNames(planLayouts(layouts, ['h', 'h', 'h'])),
+                         [(0, 2, 'two'), (2, 1, 'one')])
+        self.assertEqual(getLayoutNames(planLayouts(layouts, ['h', 'v', 'h', 'h'])),
+                         [(0, 1, 'one'), (1, 1, None), (2, 2, 'two')])
+
+    def testNoImage(self):
+        self.assertEqual(planLayouts(LayoutIndex([getLayout('one', 'h')]), []), [])
+
+    def testIdenticalInputsGiveIdenticalPlans(self):
+        signatures = ['h', 'v', 'h', 'h', 'v', 'v', 'h', 'text', 'h', 'v']
+        orientations = ['h', 'v', 'hh', 'vv', 'hv', 'vh', 'hhh', 'hvh']
+        plans = []
+        for attempt in range(3):
+            layouts = LayoutIndex([getLayout('layout-%s' % layout, layout) for layout in orientations] +
+                                  [getLayout('layout-twin-%s' % layout, layout) for layout in orientations])
+            plans.append(getLayoutNames(planLayouts(layouts, signatures)))
+        self.assertEqual(plans[1], plans[0])
+        self.assertEqual(plans[2], plans[0])
+        # On equal cost, the first layout of the configuration is chosen
+        for (index, imageNumber, name) in plans[0]:
+            self.assertFalse(name.startswith('layout-twin-'))
+
+
+class PlanChapterTest(unittest.TestCase):
+    def testImagesFittingNoLayoutAreReported(self):
+        layouts = LayoutIndex([getLayout('one', 'h'), getLayout('two', 'hh')])
+        images = [PlannedImage('1 - Beach (1).jpg', 'h'), PlannedImage('1 - Beach (2).jpg', 'v'),
+                  PlannedImage('1 - Beach (3).jpg', 'h'), PlannedImage('1 - Beach (4).jpg', 'h')]
+        (pagePlans, complete) = planChapter(layouts, 1, 'Beach', images, 3, '/album/out/')
+        self.assertFalse(complete)
+        self.assertEqual([(pagePlan.page, pagePlan.layoutName, pagePlan.chapterName) for pagePlan in pagePlans],
+                         [(3, 'one', 'Beach'), (4, 'two', '')])
+        self.assertEqual([pagePlan.paths for pagePlan in pagePlans],
+                         [['/album/1 - Beach (1).jpg'], ['/album/1 - Beach (3).jpg', '/album/1 - Beach (4).jpg']])
+
+    def testCompleteChapter(self):
+        layouts = LayoutIndex([getLayout('one', 'h')])
+        (pagePlans, complete) = planChapter(layouts, 1, 'Beach', [PlannedImage('1 - Beach (1).jpg', 'h')], 1,
+                                            '/album/out/')
+        self.assertTrue(complete)
+        self.assertEqual(len(pagePlans), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()